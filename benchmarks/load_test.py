@@ -0,0 +1,212 @@
+"""
+Load-test the /api/v1/stations endpoints and report throughput and latency percentiles, compared to a stored baseline.
+
+Run it against an API connected to a DB seeded with seed_db.py, e.g.
+    python benchmarks/load_test.py http://localhost:5000 --concurrency 16 --duration 60 --save_baseline
+then, after changing the code,
+    python benchmarks/load_test.py http://localhost:5000 --concurrency 16 --duration 60
+
+Only uses the python standard library.
+"""
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import json
+import math
+import random
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+DEFAULT_MIX = 'data_all=50,data_assimilated=15,data_forecast=10,data_mgbstandard=5,station=10,stations=5,geojson=5'
+DEFAULT_DURATIONS = '1 year,1 year,1 year,2 years,30 days'
+DEFAULT_BASELINE = 'benchmarks/baseline.json'
+
+
+def _endpoint_path(name, station_id, duration):
+    """
+    Path of the request for the given endpoint name (see DEFAULT_MIX)
+    """
+    if name == 'stations':
+        return '/api/v1/stations'
+    if name == 'geojson':
+        return '/api/v1/stations/as_geojson'
+    if name == 'station':
+        return '/api/v1/stations/{}'.format(station_id)
+    if name.startswith('data_'):
+        return '/api/v1/stations/{}/data/{}?duration={}'.format(station_id, name[len('data_'):],
+                                                               urllib.parse.quote(duration))
+    raise ValueError('Unknown endpoint {}'.format(name))
+
+
+def _parse_mix(mix):
+    weights = dict()
+    for item in mix.split(','):
+        name, weight = item.split('=')
+        weights[name.strip()] = float(weight)
+    return weights
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of an already sorted list
+    """
+    if not sorted_values:
+        return None
+    k = max(0, math.ceil(p / 100. * len(sorted_values)) - 1)
+    return sorted_values[k]
+
+
+def _summary(latencies, errors, elapsed):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed if elapsed else 0,
+        'p50_ms': percentile(latencies, 50),
+        'p95_ms': percentile(latencies, 95),
+        'p99_ms': percentile(latencies, 99),
+    }
+
+
+def run(base_url, weights, durations, concurrency, duration_s, seed, timeout):
+    """
+    Run the load test: `concurrency` workers send requests, following the weighted endpoints mix, for duration_s
+    seconds. Returns the results summary (overall and per endpoint)
+    """
+    with urllib.request.urlopen(base_url + '/api/v1/stations', timeout=timeout) as response:
+        station_ids = [st['id'] for st in json.load(response)]
+    if not station_ids:
+        raise RuntimeError('No stations found')
+
+    names = list(weights.keys())
+    results = {name: [] for name in names}
+    errors = {name: 0 for name in names}
+    lock = threading.Lock()
+    deadline = time.perf_counter() + duration_s
+
+    def worker(worker_id):
+        # one random generator per worker, so that the sequence of requests is reproducible
+        rng = random.Random(seed + worker_id)
+        while time.perf_counter() < deadline:
+            name = rng.choices(names, weights=[weights[n] for n in names])[0]
+            path = _endpoint_path(name, rng.choice(station_ids), rng.choice(durations))
+            tic = time.perf_counter()
+            try:
+                with urllib.request.urlopen(base_url + path, timeout=timeout) as response:
+                    response.read()
+                ok = True
+            except (urllib.error.URLError, OSError):
+                ok = False
+            tac = time.perf_counter()
+            with lock:
+                if ok:
+                    results[name].append((tac - tic) * 1000)
+                else:
+                    errors[name] += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    return {
+        'params': {
+            'concurrency': concurrency,
+            'duration': duration_s,
+            'mix': weights,
+            'durations': durations,
+            'seed': seed,
+        },
+        'overall': _summary([l for name in names for l in results[name]], sum(errors.values()), elapsed),
+        'endpoints': {name: _summary(results[name], errors[name], elapsed) for name in names},
+    }
+
+
+def _format_value(value, baseline_value):
+    if value is None:
+        return '-'
+    text = '{:.1f}'.format(value)
+    if baseline_value:
+        change = (value - baseline_value) / baseline_value * 100
+        text += ' ({:+.0f}%)'.format(change)
+    return text
+
+
+def report(results, baseline=None):
+    """
+    Print the results, with the relative change to the baseline if provided
+    """
+    header = '{:<20} {:>8} {:>7} {:>18} {:>18} {:>18} {:>18}'.format(
+        'endpoint', 'requests', 'errors', 'req/s', 'p50 (ms)', 'p95 (ms)', 'p99 (ms)')
+    print(header)
+    print('-' * len(header))
+    rows = [('overall', results['overall'])] + sorted(results['endpoints'].items())
+    for name, summary in rows:
+        if name == 'overall':
+            base = (baseline or {}).get('overall', {})
+        else:
+            base = (baseline or {}).get('endpoints', {}).get(name, {})
+        print('{:<20} {:>8} {:>7} {:>18} {:>18} {:>18} {:>18}'.format(
+            name, summary['requests'], summary['errors'],
+            _format_value(summary['throughput'], base.get('throughput')),
+            _format_value(summary['p50_ms'], base.get('p50_ms')),
+            _format_value(summary['p95_ms'], base.get('p95_ms')),
+            _format_value(summary['p99_ms'], base.get('p99_ms')),
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='''
+    Load-test the HYFAA backend API. Reports throughput and p50/p95/p99 latencies, per endpoint, and compares them
+    to a stored baseline
+    ''')
+    parser.add_argument('url', help='API base URL, e.g. http://localhost:5000')
+    parser.add_argument('-c', '--concurrency', type=int, default=8, help='Number of concurrent clients (default 8)')
+    parser.add_argument('-t', '--duration', type=int, default=30, help='Test duration, in seconds (default 30)')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='Weighted endpoints mix (default "{}")'.format(DEFAULT_MIX))
+    parser.add_argument('--durations', default=DEFAULT_DURATIONS,
+                        help='Comma-separated list of the duration parameters to pick from for the data requests '
+                             '(default "{}")'.format(DEFAULT_DURATIONS))
+    parser.add_argument('--seed', type=int, default=0, help='Random seed (default 0)')
+    parser.add_argument('--timeout', type=float, default=30, help='Requests timeout, in seconds (default 30)')
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE,
+                        help='Baseline file (default {})'.format(DEFAULT_BASELINE))
+    parser.add_argument('--save_baseline', action='store_true', help='Store the results as the new baseline')
+    parser.add_argument('--max_regression', type=float, default=None,
+                        help='If set, exit with an error if the overall p95 latency is more than this percentage '
+                             'above the baseline')
+    args = parser.parse_args()
+
+    results = run(args.url.rstrip('/'), _parse_mix(args.mix), [d.strip() for d in args.durations.split(',')],
+                  args.concurrency, args.duration, args.seed, args.timeout)
+
+    baseline = None
+    if not args.save_baseline:
+        try:
+            with open(args.baseline) as f:
+                baseline = json.load(f)
+            if baseline.get('params') != results['params']:
+                print('Warning: the baseline was run with different parameters: {}'.format(baseline.get('params')))
+        except FileNotFoundError:
+            print('No baseline found at {}'.format(args.baseline))
+    report(results, baseline)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+        print('Baseline saved to {}'.format(args.baseline))
+    elif baseline and args.max_regression is not None:
+        base_p95 = baseline['overall'].get('p95_ms')
+        p95 = results['overall']['p95_ms']
+        if base_p95 and p95 and (p95 - base_p95) / base_p95 * 100 > args.max_regression:
+            print('p95 latency regression above {}%'.format(args.max_regression))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
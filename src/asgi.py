@@ -0,0 +1,4 @@
+"""ASGI application entry point (optional async deployment of the API)."""
+from flask_app.asgi import init_asgi_app
+
+app = init_asgi_app()
@@ -11,6 +11,37 @@ class Config:
     SECRET_KEY = environ.get('SECRET_KEY')
     STATIC_FOLDER = 'static'
     TEMPLATES_FOLDER = 'templates'
+    DATABASE_POOL_SIZE = 20
+    # Number of DB connections opened when the app starts (in each worker). 0 to disable
+    DATABASE_POOL_WARMUP = 0
+    # Run the stations and minibasin data queries as server-side prepared statements
+    DATABASE_PREPARED_STATEMENTS = False
+    # Comma-separated list of read replicas connection strings. Read queries are load-balanced across them
+    DATABASE_REPLICA_URIS = environ.get('DATABASE_REPLICA_URIS')
+    # Delay (s) between two checks of the replication lag of a replica
+    DATABASE_REPLICA_LAG_CHECK_INTERVAL = 30
+    # hjson file defining the basins (`deployments` list, same format as the publication script configuration).
+    # Each basin is served under /api/v1/<basin>/. If not set, only the default DB is served
+    BASINS_CONFIG_PATH = environ.get('BASINS_CONFIG_PATH')
+    # Listen to the publication notifications, to evict the affected cache entries as soon as new data is published
+    EVENTS_ENABLED = False
+    # On each publication notification, pre-load the data of this number of most requested stations (0 to disable)
+    EVENTS_WARMUP_STATIONS = 0
+    # Default number of results of the nearby search endpoints
+    DEFAULT_NEARBY_LIMIT = 5
+    # Expose Prometheus metrics on /metrics (needs prometheus_client)
+    METRICS_ENABLED = False
+    # Log the requests taking longer than this (ms). 0 to disable
+    SLOW_REQUEST_THRESHOLD_MS = 0
+    # Profile the requests sent with the X-Hyfaa-Profile header set to PROFILING_TOKEN (Server-Timing header, sampled
+    # stacks)
+    PROFILING_ENABLED = False
+    # Folder the requests profiles are written in (default: STORAGE_PATH/profiles, or a temporary folder)
+    PROFILING_PATH = environ.get('PROFILING_PATH')
+    # Secret value of the X-Hyfaa-Profile header. Profiling is disabled if not set
+    PROFILING_TOKEN = environ.get('PROFILING_TOKEN')
+    # Max number of profiles kept in PROFILING_PATH (the oldest ones are removed)
+    PROFILING_MAX_FILES = 100
 
 
 class ProductionConfig(Config):
@@ -19,6 +50,8 @@ class ProductionConfig(Config):
     TESTING = False
     LOGGING_LEVEL = logging.WARN
     DATABASE_URI = environ.get('DATABASE_URI')
+    DATABASE_POOL_WARMUP = 4
+    DATABASE_PREPARED_STATEMENTS = True
 
 class StagingConfig(Config):
     FLASK_ENV = 'production'
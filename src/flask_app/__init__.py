@@ -12,6 +12,20 @@ configurations = {
 }
 ENVIRONMENT_OVERRIDES = [
     "DATABASE_URI",
+    "DATABASE_POOL_SIZE",
+    "DATABASE_POOL_WARMUP",
+    "DATABASE_PREPARED_STATEMENTS",
+    "DATABASE_REPLICA_URIS",
+    "DATABASE_REPLICA_LAG_CHECK_INTERVAL",
+    "BASINS_CONFIG_PATH",
+    "EVENTS_ENABLED",
+    "EVENTS_WARMUP_STATIONS",
+    "METRICS_ENABLED",
+    "PROFILING_ENABLED",
+    "PROFILING_PATH",
+    "PROFILING_TOKEN",
+    "PROFILING_MAX_FILES",
+    "SLOW_REQUEST_THRESHOLD_MS",
     "STORAGE_PATH",
     "DEFAULT_NEARBY_LIMIT",
 ]
@@ -36,13 +50,36 @@ def init_app():
 
     with app.app_context():
         # Import parts of our application
-        from .apis import blueprint as api
+        from .apis import blueprint as api, basins_blueprint as basins_api
         from .error_handlers import error_handlers
+        from .core import database, events
+        from . import cli, monitoring, profiling
 
         # Register Blueprints
         app.register_blueprint(api, url_prefix='/api/v1')
         app.register_blueprint(error_handlers.handlers_bp)
 
+        # Instrumentation. Must be initialized before the DB engine
+        monitoring.init_app(app)
+        profiling.init_app(app)
+
+        # Create the DB engines (after the fork, under uwsgi). The statements to prepare are declared by the APIs
+        # imports, above
+        basins = database.init_app(app)
+        if basins:
+            # Same API, on the basin's DB
+            app.register_blueprint(basins_api, url_prefix='/api/v1/<any({}):basin>'.format(', '.join(basins)))
+
+        # Publication events listeners (after the DB engines)
+        events.init_app(app)
+
+        @app.url_value_preprocessor
+        def select_basin(endpoint, values):
+            # Set for every request, since the worker threads are reused
+            database.set_current_basin(values.pop('basin', None) if values else None)
+
+        cli.init_app(app)
+
         @app.route('/')
         def redirect_root_to_apiv1():
             return redirect('/api/v1')
@@ -1,16 +1,40 @@
 from flask import Blueprint
 from flask_restx import Api
 
+from ..core import database
 from .stations import api as stations_api
+from .minibasins import api as minibasins_api
+from .tiles import api as tiles_api
+from .alerts import api as alerts_api
+from .regions import api as regions_api
+
+
+def create_api(blueprint, **kwargs):
+    api = Api(
+        app=blueprint,
+        title='HYFAA backend API',
+        version='1.0',
+        description='Provides access to MGB/HYFAA-related data',
+        contact='Jean Pommier',
+        contact_email='jean.pommier@pi-geosolutions.fr',
+        **kwargs
+    )
+    api.add_namespace(stations_api)
+    api.add_namespace(minibasins_api)
+    api.add_namespace(tiles_api)
+    api.add_namespace(alerts_api)
+    api.add_namespace(regions_api)
+    return api
+
 
 blueprint = Blueprint('api_v1', __name__)
-api_v1 = Api(
-    app=blueprint,
-    title='HYFAA backend API',
-    version='1.0',
-    description='Provides access to MGB/HYFAA-related data',
-    contact='Jean Pommier',
-    contact_email='jean.pommier@pi-geosolutions.fr',
-)
-
-api_v1.add_namespace(stations_api)
+api_v1 = create_api(blueprint)
+
+# Per-basin API, served under /api/v1/<basin>/ (see database.init_basins)
+basins_blueprint = Blueprint('api_v1_basins', __name__)
+api_v1_basins = create_api(basins_blueprint, doc=False)
+
+
+@basins_blueprint.url_defaults
+def add_basin(endpoint, values):
+    values.setdefault('basin', database.current_basin())
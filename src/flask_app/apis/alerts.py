@@ -0,0 +1,37 @@
+from flask_restx import Namespace, Resource, reqparse, inputs
+from flask import jsonify
+
+from ..core import alerts
+
+api = Namespace('alerts', description='Alerts: minibasins whose values are above their expected value or threshold')
+
+
+def alerts_parser():
+    parser = reqparse.RequestParser()
+    parser.add_argument('dataserie', default='assimilated', choices=['assimilated', 'mgbstandard', 'forecast'],
+                        location='args', help='The data serie on which the alerts are evaluated')
+    parser.add_argument('since', type=inputs.datetime_from_iso8601, location='args',
+                        help='If set, returns the alert level transitions since this date (ISO 8601), instead of the current alerts')
+    parser.add_argument('level', type=int, default=1, choices=[1, 2], location='args',
+                        help='Minimum alert level: 1 (above expected value) or 2 (above threshold)')
+    return parser
+
+
+@api.route('')
+class Alerts(Resource):
+    @api.expect(alerts_parser())
+    @api.doc(responses={
+        200: 'Success',
+        400: 'Validation Error',
+    })
+    def get(self):
+        '''
+        Retrieve the minibasins currently in alert or, if `since` is set, the alert level transitions since this date.
+        Alert levels are:
+        * "above_expected": the value is above the expected value (mean value on this same day over the years),
+        by a configured ratio
+        * "above_threshold": the value is above the minibasin's alert threshold
+        Each alert also lists the stations connected to the minibasin
+        '''
+        args = alerts_parser().parse_args()
+        return jsonify(alerts.get_alerts(args['dataserie'], args['since'], args['level']))
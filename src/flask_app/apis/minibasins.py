@@ -0,0 +1,23 @@
+from flask_restx import Namespace, Resource
+from flask import jsonify
+
+from ..core import nearby
+from .stations import nearby_parser, parse_nearby_args
+
+api = Namespace('minibasins', description='Minibasins related operations')
+
+
+@api.route('/nearby')
+class MinibasinsNearby(Resource):
+    @api.expect(nearby_parser())
+    @api.doc(responses={
+        200: 'Success',
+        400: 'Validation Error',
+    })
+    def get(self):
+        '''
+        Retrieve the minibasins closest to a location, sorted by distance.
+        The `distance` field gives the distance in meters (to a point on the minibasin's surface)
+        '''
+        lon, lat, limit = parse_nearby_args()
+        return jsonify(nearby.get_nearby_minibasins(lon, lat, limit))
@@ -0,0 +1,98 @@
+from flask_restx import Namespace, Resource, fields, reqparse, inputs, abort
+from flask import jsonify, request
+
+from ..core import regions
+
+api = Namespace('regions', description='Aggregated values over sets of minibasins (regions)')
+
+_dataseries = ['assimilated', 'mgbstandard', 'forecast']
+
+
+def aggregate_parser():
+    parser = reqparse.RequestParser()
+    parser.add_argument('variable', default='flow', choices=regions.variables, location='args',
+                        help='The aggregated variable')
+    parser.add_argument('start', type=inputs.datetime_from_iso8601, location='args',
+                        help='Start date (ISO 8601). Default: one year before the latest date')
+    parser.add_argument('end', type=inputs.datetime_from_iso8601, location='args',
+                        help='End date (ISO 8601)')
+    return parser
+
+
+aggregate_request = api.model('AggregateRequest', {
+    'cells': fields.List(fields.Integer, description='Minibasin ids'),
+    'geometry': fields.Raw(description='GeoJSON (multi)polygon, in WGS84. Used if cells is not set'),
+    'variable': fields.String(enum=regions.variables, default='flow'),
+    'start': fields.DateTime(description='Start date (ISO 8601). Default: one year before the latest date'),
+    'end': fields.DateTime(description='End date (ISO 8601)'),
+})
+
+
+@api.route('')
+class Regions(Resource):
+    def get(self):
+        '''Retrieve the named regions list'''
+        return jsonify(regions.get_regions())
+
+
+@api.route('/<string:name>/aggregate/<dataserie>')
+@api.param('name', 'The region name')
+@api.param('dataserie', 'The data serie to aggregate', enum=_dataseries)
+class RegionAggregate(Resource):
+    @api.expect(aggregate_parser())
+    @api.doc(responses={
+        200: 'Success',
+        400: 'Validation Error',
+        404: 'Region not found',
+    })
+    def get(self, name, dataserie):
+        '''
+        Retrieve the values aggregated over the minibasins of a named region, per date: number of values (`count`),
+        `mean`, `sum`, `min`, `max`, and percentiles (`p10`, `median`, `p90`)
+        '''
+        args = aggregate_parser().parse_args()
+        try:
+            result = regions.aggregate(dataserie, args['variable'], region=name, start=args['start'], end=args['end'])
+        except KeyError:
+            abort(404, 'Unknown region {}'.format(name))
+        if result is None:
+            abort(400)
+        return jsonify(result)
+
+
+@api.route('/aggregate/<dataserie>')
+@api.param('dataserie', 'The data serie to aggregate', enum=_dataseries)
+class Aggregate(Resource):
+    @api.expect(aggregate_request)
+    @api.doc(responses={
+        200: 'Success',
+        400: 'Validation Error',
+    })
+    def post(self, dataserie):
+        '''
+        Retrieve the values aggregated over a set of minibasins, per date (see the named regions endpoint).
+        The minibasins are given either as a list of ids (`cells`) or as a GeoJSON polygon (`geometry`): the
+        minibasins it intersects
+        '''
+        payload = request.get_json(silent=True) or {}
+        cells, geometry = payload.get('cells'), payload.get('geometry')
+        if cells is None and geometry is None:
+            abort(400, 'cells or geometry must be provided')
+        if cells is not None and (not isinstance(cells, list) or len(cells) > regions.MAX_REGION_CELLS
+                                  or not all(isinstance(c, int) for c in cells)):
+            abort(400, 'cells must be a list of at most {} minibasin ids'.format(regions.MAX_REGION_CELLS))
+        if cells is None and regions.validate_geometry(geometry):
+            abort(400, regions.validate_geometry(geometry))
+        try:
+            start = inputs.datetime_from_iso8601(payload['start']) if payload.get('start') else None
+            end = inputs.datetime_from_iso8601(payload['end']) if payload.get('end') else None
+        except ValueError:
+            abort(400, 'start and end must be ISO 8601 dates')
+        try:
+            result = regions.aggregate(dataserie, payload.get('variable', 'flow'), cells=cells, geometry=geometry,
+                                       start=start, end=end)
+        except ValueError as error:
+            abort(400, str(error))
+        if result is None:
+            abort(400)
+        return jsonify(result)
@@ -1,18 +1,64 @@
-from flask_restx import Namespace, Resource, fields, reqparse, abort
+import gzip
+
+from flask_restx import Namespace, Resource, fields, reqparse, inputs, abort
 from flask_restx.api import url_for
-from flask import jsonify, make_response
+from flask import current_app, jsonify, make_response, request
 
-from ..core import minibasin, stations
+from ..core import exports, minibasin, nearby, stations
 
 api = Namespace('stations', description='Stations related operations. Stations are virtual POI connected to minibasin data')
 
 str_duration_help = 'Time lapse to retrieve. Should correspond to postgresql\'s time interval (https://www.postgresql.org/docs/9.1/datatype-datetime.html), e.g. \'1 year 30 days\''
+str_since_help = 'Only retrieve the values published since this time (ISO 8601 timestamp, UTC if no time zone is given). `duration` is then ignored'
+str_since_serie_help = 'Same as `since`, for the {} dataserie only (overrides `since`), e.g. its `high_water_marks` value in a previous response'
+MAX_NEARBY_LIMIT = 100
+
+
+def nearby_parser():
+    """
+    Arguments parser for the nearby search endpoints (also used by the minibasins API)
+    """
+    parser = reqparse.RequestParser()
+    parser.add_argument('lon', type=float, required=True, location='args', help='Longitude (WGS84)')
+    parser.add_argument('lat', type=float, required=True, location='args', help='Latitude (WGS84)')
+    parser.add_argument('limit', type=int, location='args', help='Max number of results')
+    return parser
+
+
+def parse_nearby_args():
+    args = nearby_parser().parse_args()
+    if not (-180 <= args['lon'] <= 180 and -90 <= args['lat'] <= 90):
+        abort(400, 'lon/lat out of bounds')
+    limit = args['limit'] or int(current_app.config.get('DEFAULT_NEARBY_LIMIT', 5))
+    return args['lon'], args['lat'], max(1, min(limit, MAX_NEARBY_LIMIT))
+
+
+def static_export(relpath, content_type='application/json'):
+    """
+    Response serving the static export (see core/exports.py), if there is an up-to-date one. None otherwise
+    """
+    filepath = exports.get_file(relpath)
+    if filepath is None:
+        return None
+    with open(filepath, 'rb') as f:
+        data = f.read()
+    if 'gzip' in request.accept_encodings:
+        response = make_response(data)
+        response.headers.set("Content-Encoding", "gzip")
+    else:
+        response = make_response(gzip.decompress(data))
+    response.headers.set("Content-Type", content_type)
+    response.headers.set("Vary", "Accept-Encoding")
+    return response
 
 
 @api.route('')
 class Stations(Resource):
     def get(self):
         '''Retrieve stations list'''
+        response = static_export('stations.json')
+        if response is not None:
+            return response
         st_rec = stations.get_stations()
         return jsonify(st_rec)
 
@@ -22,6 +68,9 @@ class Stations(Resource):
 class StationsAsGeojson(Resource):
     def get(self):
         '''Retrieve stations as geojson feature collection'''
+        response = static_export('stations/as_geojson.json', "application/geojson")
+        if response is not None:
+            return response
         st_rec = stations.get_stations_as_geojson()
         response = make_response(st_rec)
         response.headers.set("Content-Type", "application/geojson")
@@ -29,6 +78,22 @@ class StationsAsGeojson(Resource):
 
 
 
+@api.route('/nearby')
+class StationsNearby(Resource):
+    @api.expect(nearby_parser())
+    @api.doc(responses={
+        200: 'Success',
+        400: 'Validation Error',
+    })
+    def get(self):
+        '''
+        Retrieve the stations closest to a location, sorted by distance.
+        The `distance` field gives the distance in meters
+        '''
+        lon, lat, limit = parse_nearby_args()
+        return jsonify(nearby.get_nearby_stations(lon, lat, limit))
+
+
 @api.route('/<int:id>', endpoint='station_by_id')
 @api.param('id', 'The station identifier')
 class Station(Resource):
@@ -46,22 +111,22 @@ class Station(Resource):
                 'mgbstandard':
                     {
                         'description': 'MGB simple flow modeling',
-                        'url': '{}/data/mgbstandard'.format(url_for('api_v1.station_by_id', id=id)),
+                        'url': '{}/data/mgbstandard'.format(url_for('.station_by_id', id=id)),
                     },
                 'assimilated':
                     {
                         'description': 'MGB/HYFAA Data computed with assimilation',
-                        'url': '{}/data/assimilated'.format(url_for('api_v1.station_by_id', id=id)),
+                        'url': '{}/data/assimilated'.format(url_for('.station_by_id', id=id)),
                     },
                 'forecast':
                     {
                         'description': 'MGB/HYFAA forecasts (10 days)',
-                        'url': '{}/data/forecast'.format(url_for('api_v1.station_by_id', id=id)),
+                        'url': '{}/data/forecast'.format(url_for('.station_by_id', id=id)),
                     },
                 'all':
                     {
                         'description': 'Combines the above datasets',
-                        'url': '{}/data/all'.format(url_for('api_v1.station_by_id', id=id)),
+                        'url': '{}/data/all'.format(url_for('.station_by_id', id=id)),
                     }
             }
         return jsonify(st_rec)
@@ -72,6 +137,10 @@ class Station(Resource):
 @api.param('dataserie', 'The data serie to retrieve', enum=['all', 'assimilated', 'mgbstandard', 'forecast'])
 class StationData(Resource):
     @api.param('duration', str_duration_help )
+    @api.param('since', str_since_help)
+    @api.param('since_assimilated', str_since_serie_help.format('assimilated'))
+    @api.param('since_mgbstandard', str_since_serie_help.format('mgbstandard'))
+    @api.param('since_forecast', str_since_serie_help.format('forecast'))
     @api.doc(responses={
         200: 'Success',
         400: 'Validation Error',
@@ -85,12 +154,28 @@ class StationData(Resource):
         * "flow": (m³/s) values representing the median for assimilated and forecast dataseries, the mean for mgbstandard serie
         * "flow_mad": [assimilated and forecast dataseries only] median absolute deviation
         * "expected": [assimilated and forecast dataseries only] (m³/s) the expected value, based on the mean values on this same day over the years
+
+        With `since` (or `since_<dataserie>`), only the values published since this time are returned (without "expected"), along with a "high_water_marks" field: for each dataserie, the time to use as `since_<dataserie>` in the next request. The values published on the high-water mark's day are returned again by the next request: replace the values by date
         '''
         parser = reqparse.RequestParser()
         parser.add_argument('duration', type=pg_time_interval, location='args', help=str_duration_help)
+        parser.add_argument('since', type=inputs.datetime_from_iso8601, location='args', help=str_since_help)
+        for serie in ['assimilated', 'mgbstandard', 'forecast']:
+            parser.add_argument('since_{}'.format(serie), type=inputs.datetime_from_iso8601, location='args',
+                                help=str_since_serie_help.format(serie))
         args = parser.parse_args()
+        since = {serie: args['since_{}'.format(serie)] or args['since']
+                 for serie in ['assimilated', 'mgbstandard', 'forecast']
+                 if args['since_{}'.format(serie)] or args['since']}
+        args['since'] = since or None
+        if dataserie == 'all' and args['duration'] in [None, minibasin.defaults['duration']] and not args['since']:
+            response = static_export('stations/{}/data/all.json'.format(id))
+            if response is not None:
+                stations.record_request(id)
+                return response
         data = stations.get_data(id, dataserie, args)
         if data:
+            stations.record_request(id)
             return data
         api.abort(404)
 
@@ -98,8 +183,7 @@ class StationData(Resource):
 
 def pg_time_interval(value):
     '''Parse my type'''
-    import re
-    if not re.compile('(([0-9]+) (year|month|week|day)(s)?( )?)+').fullmatch(value):
+    if not minibasin.is_valid_duration(value):
         abort(400)
 
     return value
@@ -0,0 +1,34 @@
+from flask_restx import Namespace, Resource, abort
+from flask import make_response, request
+
+from ..core import tiles
+
+api = Namespace('tiles', description='Vector tiles of the minibasins, styled by their latest published values')
+
+
+@api.produces(["application/vnd.mapbox-vector-tile"])
+@api.route('/<int:z>/<int:x>/<int:y>.mvt')
+@api.param('z', 'Zoom level')
+@api.param('x', 'Tile column')
+@api.param('y', 'Tile row (XYZ scheme)')
+class Tile(Resource):
+    @api.param('dataserie', 'The data serie providing the attributes (default: {})'.format(tiles.TILES_DATASERIE),
+               enum=['assimilated', 'mgbstandard', 'forecast'])
+    @api.doc(responses={
+        200: 'Success',
+        400: 'Validation Error',
+    })
+    def get(self, z, x, y):
+        '''
+        Retrieve a Mapbox vector tile of the minibasins (`minibasins` layer). Each feature provides the minibasin `id`,
+        the `date` of the latest published values, and the `flow`, `flow_mad` (assimilated and forecast dataseries
+        only) and `elevation` values at this date
+        '''
+        dataserie = request.args.get('dataserie', tiles.TILES_DATASERIE)
+        if dataserie not in ['assimilated', 'mgbstandard', 'forecast'] or not tiles.is_valid_tile(z, x, y):
+            abort(400)
+        tile, version = tiles.get_tile(z, x, y, dataserie)
+        response = make_response(tile)
+        response.headers.set("Content-Type", "application/vnd.mapbox-vector-tile")
+        response.set_etag(version)
+        return response.make_conditional(request)
@@ -0,0 +1,235 @@
+"""
+Optional ASGI deployment of the API (see src/asgi.py).
+Serves the same /api/v1/stations endpoints as apis/stations.py, backed by an async connection pool, so that
+slow requests don't each block a worker thread.
+Also serves the publication events stream (/api/v1/events): its clients stay connected, which only the async
+deployment can afford.
+Only the default DB and schemas are served: the basins (/api/v1/<basin>/, see database.init_basins) are only served
+by the WSGI deployment, and have no events stream.
+The swagger documentation is only served by the WSGI (Flask) deployment.
+"""
+from contextlib import asynccontextmanager
+from datetime import datetime
+import asyncio
+import json
+
+from starlette.applications import Starlette
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from .core import async_database, async_events, async_minibasin, async_stations
+from .core.minibasin import _dataseries, is_valid_duration
+
+# Delay (s) between two keepalive comments of the events stream, so that the proxies don't close idle streams
+KEEPALIVE_INTERVAL = 30
+# Max number of stations an events stream client can subscribe to
+MAX_STATIONS = 50
+
+_dataseries_descriptions = {
+    'mgbstandard': 'MGB simple flow modeling',
+    'assimilated': 'MGB/HYFAA Data computed with assimilation',
+    'forecast': 'MGB/HYFAA forecasts (10 days)',
+    'all': 'Combines the above datasets',
+}
+
+
+def _abort(status_code, message=None):
+    return JSONResponse({'message': message or 'Error {}'.format(status_code)}, status_code=status_code)
+
+
+def _parse_datetime(value):
+    """
+    Parse an ISO 8601 timestamp. Raises ValueError if invalid
+    """
+    return datetime.fromisoformat(value.replace('Z', '+00:00'))
+
+
+def _parse_since(query_params):
+    """
+    The `since` and `since_<dataserie>` parameters, as a dict {dataserie: datetime} (None if not set). Raises
+    ValueError if invalid
+    """
+    since = dict()
+    for serie in _dataseries:
+        value = query_params.get('since_{}'.format(serie)) or query_params.get('since')
+        if value:
+            since[serie] = _parse_datetime(value)
+    return since or None
+
+
+async def stations_list(request):
+    '''Retrieve stations list'''
+    st_rec = await async_stations.get_stations()
+    return JSONResponse(st_rec)
+
+
+async def stations_as_geojson(request):
+    '''Retrieve stations as geojson feature collection'''
+    st_rec = await async_stations.get_stations_as_geojson()
+    return JSONResponse(st_rec, media_type="application/geojson")
+
+
+async def station_by_id(request):
+    '''Describe a station'''
+    id = request.path_params['id']
+    st_rec = await async_stations.get_station(id)
+    if not st_rec:
+        return _abort(404)
+    station_url = request.app.url_path_for('station_by_id', id=id)
+    st_rec['dataseries'] = {
+        serie: {
+            'description': description,
+            'url': '{}/data/{}'.format(station_url, serie),
+        } for serie, description in _dataseries_descriptions.items()
+    }
+    return JSONResponse(st_rec)
+
+
+async def station_data(request):
+    '''
+    Retrieve MGB/HYFAA data for a station, given its identifier and a dataserie name (or `all` to get all available
+    dataseries). See apis/stations.py for details
+    '''
+    duration = request.query_params.get('duration')
+    if duration is not None and not is_valid_duration(duration):
+        return _abort(400)
+    try:
+        since = _parse_since(request.query_params)
+    except ValueError:
+        return _abort(400, 'since: ISO 8601 timestamp expected')
+    data = await async_stations.get_data(request.path_params['id'], request.path_params['dataserie'],
+                                         {'duration': duration, 'since': since})
+    if data:
+        return JSONResponse(data)
+    return _abort(404)
+
+
+def _sse(event, data):
+    return 'event: {}\ndata: {}\n\n'.format(event, json.dumps(data, separators=(',', ':')))
+
+
+def _publication_event(event):
+    """
+    Lightweight version of the notification payload
+    """
+    return {
+        'dataserie': event.get('table', '').replace('data_', ''),
+        'table': event.get('table'),
+        'last_updated': event.get('last_date'),
+        'first_date': event.get('first_date'),
+        'last_date': event.get('last_date'),
+        'update_errors': event.get('update_errors'),
+    }
+
+
+async def _station_events(station_ids, dataserie, high_water_marks):
+    """
+    The values of the stations published since their high-water marks, as `station` events.
+    high_water_marks: {station id: {dataserie: datetime}}, updated
+    """
+    results = await asyncio.gather(*[async_stations.get_data(id, dataserie, {'since': high_water_marks[id]})
+                                     for id in station_ids])
+    messages = []
+    for id, data in zip(station_ids, results):
+        if data is None:
+            continue
+        high_water_marks[id].update({serie: _parse_datetime(mark)
+                                     for serie, mark in data['high_water_marks'].items()})
+        if any(data['data'].values()):
+            messages.append(_sse('station', data))
+    return messages
+
+
+async def events_stream(request):
+    '''
+    Server-Sent Events stream of the publications. A `publication` event is pushed each time a dataserie is
+    published: `dataserie`, `table`, `last_updated` (latest published date), published date range (`first_date`,
+    `last_date`) and `update_errors`.
+    With `stations` (comma-separated station ids), the newly published values of these stations are pushed too, as
+    `station` events (same layout as the station data responses with `since`). With `since`, the values published
+    since this time are pushed right away
+    '''
+    if not async_events.is_enabled():
+        return _abort(503, 'Publication events are disabled (EVENTS_ENABLED)')
+    stations_param = request.query_params.get('stations')
+    try:
+        station_ids = [int(i) for i in stations_param.split(',') if i.strip()] if stations_param else []
+    except ValueError:
+        return _abort(400, 'stations: comma-separated list of station ids expected')
+    if len(station_ids) > MAX_STATIONS:
+        return _abort(400, 'stations: at most {} stations'.format(MAX_STATIONS))
+    try:
+        since = _parse_since(request.query_params)
+    except ValueError:
+        return _abort(400, 'since: ISO 8601 timestamp expected')
+    subscription = async_events.subscribe()
+    # per station and dataserie: the given `since`, else the current marks
+    marks = dict()
+    try:
+        if station_ids and (not since or len(since) < len(_dataseries)):
+            marks = {serie: _parse_datetime(mark)
+                     for serie, mark in (await async_minibasin.get_high_water_marks()).items()}
+    except Exception:
+        async_events.unsubscribe(subscription)
+        raise
+    marks.update(since or {})
+    high_water_marks = {id: dict(marks) for id in station_ids}
+
+    async def generate():
+        try:
+            # sent right away, so that the client knows the stream is open
+            yield ': connected\n\n'
+            if since and station_ids:
+                for message in await _station_events(station_ids, 'all', high_water_marks):
+                    yield message
+            while True:
+                try:
+                    event = await asyncio.wait_for(subscription.get(), KEEPALIVE_INTERVAL)
+                except asyncio.TimeoutError:
+                    yield ': keepalive\n\n'
+                    continue
+                publication = _publication_event(event)
+                yield _sse('publication', publication)
+                if station_ids and publication['dataserie'] in _dataseries:
+                    for message in await _station_events(station_ids, publication['dataserie'], high_water_marks):
+                        yield message
+        finally:
+            async_events.unsubscribe(subscription)
+
+    return StreamingResponse(generate(), media_type='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # disable the nginx buffering
+        'X-Accel-Buffering': 'no',
+    })
+
+
+@asynccontextmanager
+async def lifespan(app):
+    """
+    Open the connection pool and start the events listener on startup, stop them on shutdown
+    """
+    await async_database.init_pool()
+    await async_events.start()
+    try:
+        yield
+    finally:
+        await async_events.stop()
+        await async_database.close_pool()
+
+
+def init_asgi_app():
+    """Create the ASGI application."""
+    routes = [
+        Route('/api/v1/stations', stations_list),
+        Route('/api/v1/stations/as_geojson', stations_as_geojson),
+        Route('/api/v1/stations/{id:int}', station_by_id, name='station_by_id'),
+        Route('/api/v1/stations/{id:int}/data/{dataserie}', station_data),
+        Route('/api/v1/events', events_stream),
+    ]
+    return Starlette(
+        routes=routes,
+        middleware=[Middleware(CORSMiddleware, allow_origins=['*'])],
+        lifespan=lifespan,
+    )
@@ -0,0 +1,75 @@
+"""
+Flask CLI commands (run them with `flask <command>`, from the src folder)
+"""
+import sys
+
+import click
+
+from .core import database, exports, migrations, tiles
+
+
+def _basins(basin):
+    """
+    The basins a command applies to: the given one, or the default DB and all the basins
+    """
+    return [basin] if basin else [None] + database.get_basins()
+
+
+def init_app(app):
+    """
+    Register the commands
+    """
+    @app.cli.command('seed-tiles')
+    @click.option('--max-zoom', default=6, show_default=True, help='Seed the tiles up to this zoom level')
+    @click.option('--dataserie', default=tiles.TILES_DATASERIE, show_default=True,
+                  type=click.Choice(['assimilated', 'mgbstandard', 'forecast']))
+    @click.option('--basin', default=None, help='Basin to seed the tiles of (default DB if not set)')
+    def seed_tiles(max_zoom, dataserie, basin):
+        """Generate the minibasins vector tiles for the low zoom levels, to fill the tiles cache.
+        Meant to be run right after a publication"""
+        database.set_current_basin(basin)
+        nb = tiles.seed(max_zoom, dataserie)
+        click.echo("Seeded {} tiles".format(nb))
+
+    @app.cli.command('db-migrate')
+    @click.option('--basin', default=None, help='Basin to migrate (default DB and all the basins if not set)')
+    @click.option('--dry-run', is_flag=True, help='Only print the statements')
+    def db_migrate(basin, dry_run):
+        """Create the missing serving indexes (concurrently), and rebuild the invalid ones"""
+        for b in _basins(basin):
+            database.set_current_basin(b)
+            built = migrations.apply(dry_run)
+            click.echo("{}: {}".format(b or 'default', ', '.join(built) if built else 'up to date'))
+
+    @app.cli.command('db-check')
+    @click.option('--basin', default=None, help='Basin to check (default DB and all the basins if not set)')
+    @click.option('--analyze', is_flag=True, help='Log the actual execution time of the queries (auto_explain '
+                                                   'log_analyze, or EXPLAIN ANALYZE without auto_explain)')
+    def db_check(basin, analyze):
+        """Run the API queries with their plans logged (nested ones included, with auto_explain), and flag the ones
+        that don't use an index. Exits with status 1 if any is flagged"""
+        ok = True
+        for b in _basins(basin):
+            database.set_current_basin(b)
+            for r in migrations.check(analyze):
+                ok = ok and r['ok']
+                if r.get('skipped'):
+                    click.echo("{}: {} skipped ({})".format(b or 'default', r['name'], r['skipped']))
+                    continue
+                click.echo("{}: {} {} cost={}{} indexes={}{}".format(
+                    b or 'default', r['name'], 'OK' if r['ok'] else 'REGRESSION', r['cost'],
+                    ' time={}ms'.format(r['time']) if analyze else '', ','.join(r['indexes']) or '-',
+                    ' seq scan on {}'.format(','.join(r['seq_scans'])) if r['seq_scans'] else ''))
+                if r.get('warning'):
+                    click.echo("{}: {} warning: {}".format(b or 'default', r['name'], r['warning']))
+        if not ok:
+            sys.exit(1)
+
+    @app.cli.command('export-static')
+    @click.option('--basin', default=None, help='Basin to export (default DB and all the basins if not set)')
+    def export_static(basin):
+        """Render the static exports (stations list and GeoJSON, `all` data of each station). Meant to be run right
+        after a publication"""
+        for b in _basins(basin):
+            version = exports.export(b)
+            click.echo("{}: {}".format(b or 'default', version or 'disabled'))
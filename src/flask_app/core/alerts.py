@@ -0,0 +1,73 @@
+# encoding: utf-8
+"""
+Functions related to alerts. Alerts are detected by the publication script (see hyfaa_netcdf2DB._detect_alerts),
+which records the alert level transitions in the hyfaa.alert_events table and the current levels in the
+hyfaa.alert_state table
+"""
+from . import database
+
+levels = {
+    0: 'normal',
+    1: 'above_expected',
+    2: 'above_threshold',
+}
+_accepted_datatypes = ['assimilated', 'mgbstandard', 'forecast']
+
+_current_alerts_query = """
+    SELECT a.cell_id, a.level, a.since, a.value, a.expected, a.threshold,
+           array_remove(array_agg(s.id ORDER BY s.id), NULL) AS stations
+    FROM {schema}.alert_state a
+    LEFT JOIN {geo_schema}.stations s ON s.minibasin = a.cell_id
+    WHERE a.tablename = :tablename AND a.level >= :min_level AND a.level > 0
+    GROUP BY a.cell_id, a.level, a.since, a.value, a.expected, a.threshold
+    ORDER BY a.level DESC, a.cell_id
+"""
+
+_alert_events_query = """
+    SELECT e.cell_id, e.date, e.level, e.previous_level, e.value, e.expected, e.threshold,
+           array_remove(array_agg(s.id ORDER BY s.id), NULL) AS stations
+    FROM {schema}.alert_events e
+    LEFT JOIN {geo_schema}.stations s ON s.minibasin = e.cell_id
+    WHERE e.tablename = :tablename AND e.date >= :since
+      AND (e.level >= :min_level OR e.previous_level >= :min_level)
+    GROUP BY e.id
+    ORDER BY e.date, e.cell_id
+"""
+
+
+def _record(row):
+    rec = {
+        'minibasin': row['cell_id'],
+        'stations': list(row['stations']),
+        'level': levels.get(row['level']),
+        'value': row['value'],
+        'expected': row['expected'],
+        'threshold': row['threshold'],
+    }
+    if 'since' in row.keys():
+        rec['since'] = row['since'].isoformat() if row['since'] else None
+    else:
+        rec['date'] = row['date'].isoformat()
+        rec['previous_level'] = levels.get(row['previous_level'])
+    return rec
+
+
+def get_alerts(datatype='assimilated', since=None, min_level=1):
+    """
+    Retrieve the alerts
+    Params:
+      * datatype: should be one of _accepted_datatypes values
+      * since: datetime. If None, returns the minibasins currently in alert. Otherwise, returns the alert level
+        transitions (alert events) that happened on this date or after, entering or leaving this level
+      * min_level: only return the alerts of this level or above (1: above expected, 2: above threshold)
+    Returns a list of dicts, or None if the datatype is not supported
+    """
+    if datatype not in _accepted_datatypes:
+        return None
+    params = {'tablename': 'data_{}'.format(datatype), 'min_level': min_level}
+    with database.connect() as conn:
+        if since is None:
+            rs = conn.execute(database.sql(_current_alerts_query), **params)
+        else:
+            rs = conn.execute(database.sql(_alert_events_query), since=since, **params)
+        return [_record(row) for row in rs.fetchall()]
@@ -0,0 +1,52 @@
+"""
+Configure the async database connection pool (asyncpg), used by the ASGI deployment of the API.
+Like database.py, it can be used independently from Flask
+"""
+
+from os import environ
+import json
+
+import asyncpg
+
+DATABASE_URI = environ.get('DATABASE_URI')
+ASYNC_POOL_MIN_SIZE = int(environ.get('ASYNC_POOL_MIN_SIZE', 5))
+ASYNC_POOL_MAX_SIZE = int(environ.get('ASYNC_POOL_MAX_SIZE', 50))
+
+pool = None
+
+
+async def _init_connection(conn):
+    """
+    Called on every new connection of the pool
+    """
+    # Decode json values into python objects, like psycopg2 does for the sync engine
+    for typename in ['json', 'jsonb']:
+        await conn.set_type_codec(typename, schema='pg_catalog',
+                                  encoder=json.dumps, decoder=json.loads, format='text')
+    # Durations are given as textual PostgreSQL intervals (e.g. '1 year 30 days'): let PostgreSQL parse them
+    await conn.set_type_codec('interval', schema='pg_catalog', encoder=str, decoder=str, format='text')
+
+
+async def init_pool(uri=None, min_size=ASYNC_POOL_MIN_SIZE, max_size=ASYNC_POOL_MAX_SIZE):
+    """
+    Create the connection pool. Needs to be called from within the event loop (e.g. on ASGI app startup)
+    """
+    global pool
+    if pool is None:
+        pool = await asyncpg.create_pool(
+            uri or DATABASE_URI,
+            min_size=min_size,
+            max_size=max_size,
+            init=_init_connection,
+        )
+    return pool
+
+
+async def close_pool():
+    """
+    Close the connection pool (e.g. on ASGI app shutdown)
+    """
+    global pool
+    if pool is not None:
+        await pool.close()
+        pool = None
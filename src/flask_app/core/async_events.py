@@ -0,0 +1,106 @@
+"""
+Publication events, async version (see events.py), used by the Server-Sent Events stream of the ASGI deployment (see
+asgi.py): a single connection per worker listens to the publication notifications, and puts the events of the
+default schema in the queue of each stream client. Enabled by EVENTS_ENABLED.
+Like the rest of the ASGI deployment, only the default DB and schemas are served: the basins (see
+database.init_basins) have no events stream
+"""
+from os import environ
+import asyncio
+import json
+import logging
+
+import asyncpg
+
+from . import async_database
+from .database import DATABASE_SCHEMA
+from .events import NOTIFY_CHANNEL, RECONNECT_DELAY
+
+EVENTS_ENABLED = str(environ.get('EVENTS_ENABLED', False)).lower() in ['true', '1', 'yes']
+# Max number of events waiting to be sent to a stream client. A client that lags further behind misses events
+SUBSCRIBER_QUEUE_SIZE = 100
+
+# Stream clients queues
+_subscribers = set()
+_task = None
+
+
+def is_enabled():
+    """
+    Whether the listener is started (EVENTS_ENABLED)
+    """
+    return _task is not None
+
+
+def subscribe():
+    """
+    Subscribe to the publication events. Returns the queue the events are put in
+    """
+    q = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+    _subscribers.add(q)
+    return q
+
+
+def unsubscribe(q):
+    _subscribers.discard(q)
+
+
+def _on_notification(connection, pid, channel, payload):
+    try:
+        event = json.loads(payload)
+    except ValueError:
+        logging.warning("Invalid publication event: {}".format(payload))
+        return
+    if event.get('schema') != DATABASE_SCHEMA:
+        return
+    for q in list(_subscribers):
+        try:
+            q.put_nowait(event)
+        except asyncio.QueueFull:
+            logging.warning("Events stream client too slow: event dropped")
+
+
+async def _listen():
+    while True:
+        conn = None
+        try:
+            # dedicated connection, out of the pool
+            conn = await asyncpg.connect(async_database.DATABASE_URI)
+            await conn.add_listener(NOTIFY_CHANNEL, _on_notification)
+            logging.info("Listening to the publication events")
+            while True:
+                # fails if the connection is lost
+                await conn.fetchval('SELECT 1')
+                await asyncio.sleep(RECONNECT_DELAY)
+        except asyncio.CancelledError:
+            raise
+        except Exception as error:
+            logging.warning("Publication events listener error: {}. Reconnecting in {}s".format(
+                error, RECONNECT_DELAY))
+        finally:
+            if conn is not None:
+                conn.terminate()
+        await asyncio.sleep(RECONNECT_DELAY)
+
+
+async def start():
+    """
+    Start the listener, if EVENTS_ENABLED (e.g. on ASGI app startup)
+    """
+    global _task
+    if EVENTS_ENABLED and _task is None:
+        _task = asyncio.ensure_future(_listen())
+
+
+async def stop():
+    """
+    Stop the listener (e.g. on ASGI app shutdown)
+    """
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
@@ -0,0 +1,103 @@
+# encoding: utf-8
+"""
+Functions related to minibasins, async version (see minibasin.py)
+The dataseries are retrieved concurrently, each one on its own pool connection
+"""
+from datetime import datetime, timezone
+import asyncio
+
+from . import async_database
+from .database import format_schemas
+from .minibasin import (_accepted_datatypes, _changes_columns, _changes_queries, _dataseries, _julianday_to_datetime,
+                        _published_query, defaults)
+
+_queries = {
+    'assimilated': "SELECT hyfaa.get_assimilated_values_for_minibasin($1, $2)",
+    'mgbstandard': "SELECT hyfaa.get_mgbstandard_values_for_minibasin($1, $2)",
+    'forecast': "SELECT hyfaa.get_forecast_values_for_minibasin($1, $2)",
+}
+_changes_queries = {serie: format_schemas(query.replace(':id', '$1').replace(':since', '$2'))
+                    for serie, query in _changes_queries.items()}
+_published_query = format_schemas(_published_query)
+
+
+async def get_data(id, datatype, opts):
+    """
+    Retrieve data for the given minibasin.
+    Params:
+      * id: minibasin identifier. Also known as cell_id in the DB
+      * datatype: should be one of _accepted_datatypes values
+      * opts: filtering options
+        * duration: Time lapse to retrieve. Should be consistent with the textual representation of a PostgreSQL date/time interval (https://www.postgresql.org/docs/9.1/datatype-datetime.html). Default is '1 year'
+        * since: if set (datetime, or dict {dataserie: datetime}), only retrieve the rows updated since this time, see
+          get_changes(). duration is then ignored
+    """
+    # read options
+    duration = opts.get('duration') or defaults['duration']
+
+    if datatype not in _accepted_datatypes:
+        return {
+                   'minibasin_id': id,
+                   'data': dict(),
+                   'error': 'datatype not recognized. Should be one of `{}`'.format(', '.join(_accepted_datatypes))
+               }
+    if opts.get('since'):
+        return await get_changes(id, datatype, opts['since'])
+
+    series = [s for s in ['assimilated', 'mgbstandard', 'forecast'] if datatype in ['all', s]]
+    results = await asyncio.gather(*[_get_serie_data(s, id, duration) for s in series])
+    return {'id': id, 'data': dict(zip(series, results))}
+
+
+async def _get_serie_data(serie, minibasin_id, duration='1 year'):
+    json_output = {'error': 'no result'}
+    async with async_database.pool.acquire() as conn:
+        mini_record = await conn.fetchrow(_queries[serie], minibasin_id, duration)
+        if mini_record:
+            json_output = mini_record[0]
+    return json_output
+
+
+async def _published_marks(conn):
+    rows = await conn.fetch(_published_query)
+    return {row[0].replace('data_', ''): _julianday_to_datetime(row[1]) for row in rows
+            if row[0].replace('data_', '') in _dataseries and row[1]}
+
+
+async def get_changes(id, datatype, since):
+    """
+    Retrieve the rows of the given minibasin updated (published) since a given time, and the high-water mark of each
+    dataserie. See minibasin.get_changes()
+    """
+    if not isinstance(since, dict):
+        since = {serie: since for serie in _dataseries}
+    values = dict()
+    sinces = dict()
+    high_water_marks = dict()
+    async with async_database.pool.acquire() as conn:
+        # read before the data: the rows of the runs it reports are committed
+        published = await _published_marks(conn)
+        for serie in _dataseries:
+            if datatype not in ['all', serie]:
+                continue
+            serie_since = since.get(serie) or datetime.min
+            if serie_since.tzinfo is not None:
+                # update_time is stored as UTC, without time zone
+                serie_since = serie_since.astimezone(timezone.utc).replace(tzinfo=None)
+            rows = await conn.fetch(_changes_queries[serie], id, serie_since)
+            values[serie] = []
+            for row in rows:
+                item = {'date': row['date'].isoformat()}
+                item.update({name: row[name] for name in _changes_columns[serie]})
+                values[serie].append(item)
+            sinces[serie] = serie_since.isoformat()
+            high_water_marks[serie] = max(serie_since, published.get(serie, datetime.min)).isoformat()
+    return {'id': id, 'data': values, 'since': sinces, 'high_water_marks': high_water_marks}
+
+
+async def get_high_water_marks():
+    """
+    High-water mark of each published dataserie, see minibasin.get_high_water_marks()
+    """
+    async with async_database.pool.acquire() as conn:
+        return {serie: mark.isoformat() for serie, mark in (await _published_marks(conn)).items()}
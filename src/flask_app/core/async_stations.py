@@ -0,0 +1,76 @@
+# encoding: utf-8
+"""
+Functions related to stations, async version (see stations.py)
+"""
+from . import async_database
+from .database import format_schemas
+from .async_minibasin import get_data as get_minibasin_data
+from .stations import _geojson_query
+
+_geojson_query = format_schemas(_geojson_query)
+
+
+def _station_record(row):
+    return {
+        'id': row['id'],
+        'minibasin': row['minibasin'],
+        'city': row['city']
+    }
+
+
+async def get_stations():
+    """
+    Retrieve stations records from geospatial.stations table
+    Returns a list of dicts
+    """
+    async with async_database.pool.acquire() as conn:
+        records = await conn.fetch("SELECT * FROM geospatial.stations")
+        return [_station_record(row) for row in records]
+
+
+async def get_stations_as_geojson():
+    """
+    Retrieve stations records from geospatial.stations_geo view
+    Returns geojson feature collection
+    """
+    async with async_database.pool.acquire() as conn:
+        record = await conn.fetchrow(_geojson_query)
+        return record[0]
+
+
+async def get_station(id):
+    """
+    Retrieve a station record from geospatial.stations table
+    Params:
+        * id: id of the station (*not the minibasin id*)
+    Returns a dict
+    """
+    async with async_database.pool.acquire() as conn:
+        record = await conn.fetchrow("SELECT * FROM geospatial.stations WHERE id = $1", id)
+        if record:
+            return _station_record(record)
+    return None
+
+
+async def get_data(id, datatype, opts):
+    """
+    Retrieve data for the given station id: retrieve the minibasin ID for this station, then calls
+    async_minibasin.get_data
+    Params:
+      * id: station identifier. (note: this is *not* the minibasin id)
+      * datatype: should be one of _accepted_datatypes values
+      * opts: filtering options
+        * duration: Time lapse to retrieve. Should be consistent with the textual representation of a PostgreSQL date/time interval (https://www.postgresql.org/docs/9.1/datatype-datetime.html). Default is '1 year'
+        * since: only retrieve the rows updated since this time (datetime, or dict {dataserie: datetime}). The
+          `since` and `high_water_marks` fields are then added, see minibasin.get_changes()
+    """
+    # Don't hold a connection while the dataseries are retrieved: they use their own connections
+    st = await get_station(id)
+    if st:
+        minibasin_data = await get_minibasin_data(st['minibasin'], datatype, opts)
+        st['data'] = minibasin_data['data']
+        if 'high_water_marks' in minibasin_data:
+            st['since'] = minibasin_data['since']
+            st['high_water_marks'] = minibasin_data['high_water_marks']
+        return st
+    return None
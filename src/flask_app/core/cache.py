@@ -0,0 +1,58 @@
+# encoding: utf-8
+"""
+In-memory caches. Entries are usually keyed by the data version (see state.py), so that they are not served anymore
+after a publication
+"""
+from collections import OrderedDict
+import threading
+
+from . import metrics
+
+
+class LRUCache:
+    """
+    Thread-safe, in-memory, least-recently-used cache.
+    Lookups are counted in the cache metrics (see metrics.py), under the cache name
+    """
+    def __init__(self, name, maxsize=1024):
+        self.name = name
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries[key]
+                self._entries.move_to_end(key)
+                hit = True
+            except KeyError:
+                value = default
+                hit = False
+        metrics.record_cache_lookup(self.name, hit)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def evict(self, predicate=None):
+        """
+        Remove the entries whose key matches the predicate (all the entries if predicate is None)
+        Returns the number of evicted entries
+        """
+        with self._lock:
+            if predicate is None:
+                nb = len(self._entries)
+                self._entries.clear()
+                return nb
+            keys = [k for k in self._entries if predicate(k)]
+            for k in keys:
+                del self._entries[k]
+            return len(keys)
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,21 +1,469 @@
 """
 Configure database connection. Can be used independently from Flask, if necessary
 See https://towardsdatascience.com/use-flask-and-sqlalchemy-not-flask-sqlalchemy-5a64fafe22a4
+
+The engines are not created at import time: under uwsgi, the app is loaded by the master process, then forked into
+the workers, and the connections would be shared across the workers. Use init_app() (or init_engine()) to create
+them, and connect() to check out a connection.
+
+Read queries can be load-balanced across read replicas (DATABASE_REPLICA_URIS), use get_read_engine() (or connect())
+for them. A replica whose hyfaa.state is behind the primary's is considered lagging, and is not used until it has
+caught up.
+
+Several deployments (basins) can be served, each one with its own schemas and connection pools (see init_basins()).
+The queries are written with `{schema}` (data schema, default `hyfaa`) and `{geo_schema}` (default `geospatial`)
+placeholders, see sql(), and are run on the current basin's DB (see set_current_basin()).
 """
 
-from os import environ, path
-import json
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import environ
+import itertools
+import logging
+import re
+import threading
+import time
 
-from sqlalchemy import create_engine
+import hjson
+from sqlalchemy import create_engine, event, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 
+try:
+    # only available when running under uwsgi
+    from uwsgidecorators import postfork
+except ImportError:
+    postfork = None
+
 DATABASE_URI = environ.get('DATABASE_URI')
-engine = create_engine (
-    DATABASE_URI,
-    pool_size=20,
-    max_overflow=0,
-)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+# Comma-separated list of read replicas connection strings
+DATABASE_REPLICA_URIS = environ.get('DATABASE_REPLICA_URIS', '')
+# Delay (s) between two checks of the replication lag of a replica
+DATABASE_REPLICA_LAG_CHECK_INTERVAL = int(environ.get('DATABASE_REPLICA_LAG_CHECK_INTERVAL', 30))
+# Timeout (s) of the connection and of the state query of a replica lag check, so that a hanging replica is considered
+# lagging instead of holding the check
+DATABASE_REPLICA_CHECK_TIMEOUT = int(environ.get('DATABASE_REPLICA_CHECK_TIMEOUT', 5))
+DATABASE_POOL_SIZE = int(environ.get('DATABASE_POOL_SIZE', 20))
+# Number of connections opened as soon as the engine is created (0 to disable)
+DATABASE_POOL_WARMUP = int(environ.get('DATABASE_POOL_WARMUP', 0))
+# Run the most frequent queries as server-side prepared statements
+DATABASE_PREPARED_STATEMENTS = environ.get('DATABASE_PREPARED_STATEMENTS', 'false').lower() in ['true', '1', 'yes']
+DATABASE_SCHEMA = 'hyfaa'
+DATABASE_GEO_SCHEMA = 'geospatial'
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False)
 
 Base = declarative_base()
+
+# Queries that can be run as server-side prepared statements, see declare_statement()
+_statements = dict()
+
+# Default DB, and the basins DBs
+_default = None
+_basins = dict()
+_current_basin = ContextVar('hyfaa_basin', default=None)
+
+# Functions called on engine creation (fn(engine, name)) and on connection checkout (fn(engine_name, wait_time)).
+# Used for instrumentation, see metrics.py
+_engine_hooks = []
+_checkout_observers = []
+
+
+def add_engine_hook(fn):
+    """
+    Register a function to call on each engine creation, with arguments (engine, engine_name)
+    """
+    _engine_hooks.append(fn)
+
+
+def add_checkout_observer(fn):
+    """
+    Register a function to call on each connection checkout (see connect()), with arguments (engine_name, wait_time)
+    """
+    _checkout_observers.append(fn)
+
+
+def declare_statement(name, sql, params):
+    """
+    Declare a query that will be run as a server-side prepared statement, if enabled (see DATABASE_PREPARED_STATEMENTS).
+    The statement is then prepared once on every new connection, saving the parsing and planning on each request.
+    Params:
+      * name: statement name. Must be unique
+      * sql: the query, using SQLAlchemy's named parameters (e.g. `:id`) and the schemas placeholders (see sql())
+      * params: ordered list of the parameter names
+    Returns the statement name, to be used with statement()
+    """
+    pg_sql = sql
+    for i, p in enumerate(params):
+        pg_sql = re.sub(r':{}\b'.format(p), '${}'.format(i + 1), pg_sql)
+    _statements[name] = {
+        'prepare': 'PREPARE {} AS {}'.format(name, pg_sql),
+        'execute': 'EXECUTE {}({})'.format(name, ', '.join([':{}'.format(p) for p in params])),
+        'query': sql,
+    }
+    return name
+
+
+def statement_query(name):
+    """
+    Get the query of a declared statement (see declare_statement()), with the schemas placeholders
+    """
+    return _statements[name]['query']
+
+
+def format_schemas(sql, schema=DATABASE_SCHEMA, geo_schema=DATABASE_GEO_SCHEMA):
+    """
+    Replace the `{schema}` and `{geo_schema}` placeholders in a query (defaults to the default DB schemas)
+    """
+    return sql.replace('{schema}', schema).replace('{geo_schema}', geo_schema)
+
+
+class Database:
+    """
+    Engines (primary and read replicas) of a DB, and the schemas the data lives in.
+    There is a default one, plus one per basin (see init_basins())
+    """
+    def __init__(self, name, uri, pool_size=DATABASE_POOL_SIZE, prepared_statements=DATABASE_PREPARED_STATEMENTS,
+                 replica_uris=None, replica_lag_check_interval=DATABASE_REPLICA_LAG_CHECK_INTERVAL,
+                 schema=DATABASE_SCHEMA, geo_schema=DATABASE_GEO_SCHEMA):
+        self.name = name
+        self.schemas = {'schema': schema, 'geo_schema': geo_schema}
+        self.pool_size = pool_size
+        self.prepared_statements = prepared_statements
+        self._queries = dict()
+        self._engine_names = dict()
+        label = name or 'default'
+        self.engine = self._create_engine(uri, '{}/primary'.format(label))
+        self.replica_engines = [self._create_engine(u, '{}/replica{}'.format(label, i))
+                                for i, u in enumerate(replica_uris or [])]
+        self._replicas_cycle = itertools.cycle(range(len(self.replica_engines)))
+        self._replicas_lock = threading.Lock()
+        self._replicas_status = dict()
+        self._replicas_checking = set()
+        self._replica_lag_check_interval = replica_lag_check_interval
+
+    def _create_engine(self, uri, engine_name):
+        new_engine = create_engine (
+            uri,
+            pool_size=self.pool_size,
+            max_overflow=0,
+            connect_args={'connect_timeout': DATABASE_REPLICA_CHECK_TIMEOUT} if '/replica' in engine_name else {},
+        )
+        if self.prepared_statements:
+            event.listen(new_engine, 'connect', self._prepare_statements)
+        self._engine_names[new_engine] = engine_name
+        for fn in _engine_hooks:
+            fn(new_engine, engine_name)
+        return new_engine
+
+    def _prepare_statements(self, dbapi_connection, connection_record):
+        """
+        Prepare the declared statements on a new DBAPI connection
+        """
+        cursor = dbapi_connection.cursor()
+        try:
+            for st in _statements.values():
+                cursor.execute(self.format(st['prepare']))
+            dbapi_connection.commit()
+        finally:
+            cursor.close()
+
+    def format(self, sql):
+        """
+        Replace the schemas placeholders in the query
+        """
+        return format_schemas(sql, **self.schemas)
+
+    def sql(self, query):
+        """
+        Get the text() query, the schemas placeholders being replaced by this DB schemas
+        """
+        q = self._queries.get(query)
+        if q is None:
+            q = text(self.format(query))
+            self._queries[query] = q
+        return q
+
+    def statement(self, name):
+        """
+        Get the query to execute for a declared statement (see declare_statement())
+        """
+        st = _statements[name]
+        return self.sql(st['execute'] if self.prepared_statements else st['query'])
+
+    def engine_name(self, e):
+        return self._engine_names.get(e)
+
+    def get_read_engine(self):
+        """
+        Get an engine for read-only queries: the next up-to-date read replica if there are some, the primary otherwise
+        """
+        if not self.replica_engines:
+            return self.engine
+        for i in range(len(self.replica_engines)):
+            with self._replicas_lock:
+                idx = next(self._replicas_cycle)
+            if self._is_replica_up_to_date(idx):
+                return self.replica_engines[idx]
+        logging.debug("No up-to-date read replica available, using the primary")
+        return self.engine
+
+    def _read_state(self, e):
+        with e.connect() as conn:
+            with conn.begin():
+                conn.execute(text("SET LOCAL statement_timeout = {}".format(DATABASE_REPLICA_CHECK_TIMEOUT * 1000)))
+                rs = conn.execute(self.sql(
+                    "SELECT tablename, last_updated_jd, last_updated_without_errors_jd FROM {schema}.state"))
+                return {row[0]: tuple(row[1:]) for row in rs.fetchall()}
+
+    def _is_replica_up_to_date(self, idx):
+        """
+        Check (at most every _replica_lag_check_interval seconds) that the replica's state table is the same as the
+        primary's. The check is run by the first request finding the status outdated, outside _replicas_lock: the
+        other requests meanwhile use the last known status (lagging if there is none yet)
+        """
+        now = time.monotonic()
+        with self._replicas_lock:
+            checked_at, up_to_date = self._replicas_status.get(idx, (None, False))
+            if (checked_at is not None and now - checked_at < self._replica_lag_check_interval) \
+                    or idx in self._replicas_checking:
+                return up_to_date
+            self._replicas_checking.add(idx)
+        try:
+            up_to_date = self._read_state(self.replica_engines[idx]) == self._read_state(self.engine)
+            if not up_to_date:
+                logging.info("Read replica {} is lagging behind the primary".format(idx))
+        except Exception as error:
+            logging.warning("Could not check the state of read replica {}: {}".format(idx, error))
+            up_to_date = False
+        finally:
+            with self._replicas_lock:
+                self._replicas_checking.discard(idx)
+                self._replicas_status[idx] = (time.monotonic(), up_to_date)
+        return up_to_date
+
+    def invalidate_replicas_status(self):
+        """
+        Force the replicas to be checked again before being used (e.g. after a publication: they might be lagging)
+        """
+        with self._replicas_lock:
+            self._replicas_status.clear()
+
+    def warm_up(self, nb_connections):
+        for e in [self.engine] + self.replica_engines:
+            warm_up(e, min(nb_connections, self.pool_size))
+
+    def dispose(self):
+        for e in [self.engine] + self.replica_engines:
+            e.dispose()
+
+
+def _split_uris(uris):
+    if isinstance(uris, str):
+        return [u.strip() for u in uris.split(',') if u.strip()]
+    return uris or []
+
+
+def init_engine(uri=None, pool_size=DATABASE_POOL_SIZE, warmup=DATABASE_POOL_WARMUP,
+                prepared_statements=DATABASE_PREPARED_STATEMENTS, replica_uris=DATABASE_REPLICA_URIS,
+                replica_lag_check_interval=DATABASE_REPLICA_LAG_CHECK_INTERVAL):
+    """
+    Create (or re-create) the default DB engines. Must be called in the process that will use them (i.e. after the
+    fork)
+    Params:
+      * uri: DB connection string. Defaults to DATABASE_URI env. var
+      * pool_size: connection pool size
+      * warmup: number of connections to open right away, so the first requests don't pay the connection setup
+      * prepared_statements: run the declared statements as server-side prepared statements
+      * replica_uris: read replicas connection strings (comma-separated string or list)
+      * replica_lag_check_interval: delay (s) between two checks of the replication lag of a replica
+    Returns the primary engine
+    """
+    global _default
+    if _default is not None:
+        _default.dispose()
+    _default = Database(None, uri or DATABASE_URI, pool_size, prepared_statements, _split_uris(replica_uris),
+                        replica_lag_check_interval)
+    SessionLocal.configure(bind=_default.engine)
+    if warmup:
+        _default.warm_up(warmup)
+    return _default.engine
+
+
+def init_basins(basins, pool_size=DATABASE_POOL_SIZE, warmup=DATABASE_POOL_WARMUP,
+                prepared_statements=DATABASE_PREPARED_STATEMENTS,
+                replica_lag_check_interval=DATABASE_REPLICA_LAG_CHECK_INTERVAL):
+    """
+    Create the basins DB engines. Each basin has its own connection pools, so that a busy basin doesn't starve the
+    other ones.
+    Params:
+      * basins: list of basins definitions (see load_basins_config()). A basin without database_uri uses the default
+        DB (and its read replicas)
+      * other params: see init_engine()
+    """
+    for db in _basins.values():
+        db.dispose()
+    _basins.clear()
+    default = get_database(None)
+    for b in basins:
+        if b.get('database_uri'):
+            uri, replica_uris = b['database_uri'], _split_uris(b.get('replica_uris'))
+        else:
+            uri, replica_uris = default.engine.url, [e.url for e in default.replica_engines]
+        db = Database(b['name'], uri, int(b.get('pool_size', pool_size)), prepared_statements, replica_uris,
+                      replica_lag_check_interval, schema=b.get('schema', DATABASE_SCHEMA),
+                      geo_schema=b.get('geo_schema', DATABASE_GEO_SCHEMA))
+        _basins[b['name']] = db
+        if warmup:
+            db.warm_up(warmup)
+
+
+def load_basins_config(config_path):
+    """
+    Read the basins definitions from the `deployments` list of a hjson file (the publication script configuration,
+    see conf/script_config.hjson). Each deployment provides a `name`, and optionally a `schema`, `geo_schema`,
+    `database_uri`, `replica_uris` and `pool_size`. Returns an empty list if there is no such list
+    """
+    if not config_path:
+        return []
+    try:
+        with open(config_path) as config_file:
+            conf = hjson.load(config_file)
+    except FileNotFoundError:
+        return []
+    return [dict(d) for d in conf.get('deployments', [])]
+
+
+def get_basins():
+    """
+    Get the names of the configured basins
+    """
+    return list(_basins.keys())
+
+
+def set_current_basin(name):
+    """
+    Set the basin the queries will be run on, in the current context (thread or task). None for the default DB
+    Raises a KeyError if the basin is not configured
+    """
+    if name is not None and name not in _basins:
+        raise KeyError(name)
+    _current_basin.set(name)
+
+
+def current_basin():
+    return _current_basin.get()
+
+
+def get_database(basin=None):
+    """
+    Get the Database of the given basin (of the current basin if None)
+    """
+    name = basin or _current_basin.get()
+    if name is not None:
+        return _basins[name]
+    if _default is None:
+        init_engine()
+    return _default
+
+
+def get_engine():
+    """
+    Get the primary engine of the current basin, create the default one if it doesn't exist yet
+    """
+    return get_database().engine
+
+
+def get_read_engine():
+    """
+    Get an engine for read-only queries on the current basin (see Database.get_read_engine())
+    """
+    return get_database().get_read_engine()
+
+
+def sql(query):
+    """
+    Get the text() query for the current basin: the `{schema}` and `{geo_schema}` placeholders are replaced with the
+    basin's schemas
+    """
+    return get_database().sql(query)
+
+
+def statement(name):
+    """
+    Get the query to execute for a declared statement (see declare_statement()), for the current basin
+    """
+    return get_database().statement(name)
+
+
+@contextmanager
+def connect(read_only=True):
+    """
+    Check out a connection from the pool of the current basin (from a read replica if read_only and there are some,
+    see get_read_engine())
+    Usage: `with database.connect() as conn:`
+    """
+    db = get_database()
+    e = db.get_read_engine() if read_only else db.engine
+    tic = time.perf_counter()
+    conn = e.connect()
+    if _checkout_observers:
+        wait_time = time.perf_counter() - tic
+        for fn in _checkout_observers:
+            fn(db.engine_name(e), wait_time)
+    try:
+        yield conn
+    finally:
+        conn.close()
+
+
+def warm_up(e, nb_connections):
+    """
+    Open nb_connections connections on the engine e and return them to the pool
+    """
+    try:
+        connections = [e.connect() for i in range(nb_connections)]
+        for conn in connections:
+            conn.close()
+        logging.info("DB connection pool warmed up with {} connections ({})".format(nb_connections, e.url.host))
+    except Exception as error:
+        # Not fatal: the connections will be opened when needed
+        logging.warning("Could not warm up the DB connection pool: {}".format(error))
+
+
+def init_app(app):
+    """
+    Configure the engines from the Flask app configuration.
+    Under uwsgi, the engines are created in each worker, after the fork
+    Returns the names of the configured basins
+    """
+    settings = dict(
+        pool_size=int(app.config.get('DATABASE_POOL_SIZE', DATABASE_POOL_SIZE)),
+        warmup=int(app.config.get('DATABASE_POOL_WARMUP', DATABASE_POOL_WARMUP)),
+        prepared_statements=str(app.config.get('DATABASE_PREPARED_STATEMENTS',
+                                               DATABASE_PREPARED_STATEMENTS)).lower() in ['true', '1', 'yes'],
+        replica_lag_check_interval=int(app.config.get('DATABASE_REPLICA_LAG_CHECK_INTERVAL',
+                                                      DATABASE_REPLICA_LAG_CHECK_INTERVAL)),
+    )
+    basins = load_basins_config(app.config.get('BASINS_CONFIG_PATH'))
+
+    def _init():
+        init_engine(
+            uri=app.config.get('DATABASE_URI'),
+            replica_uris=app.config.get('DATABASE_REPLICA_URIS') or DATABASE_REPLICA_URIS,
+            **settings
+        )
+        init_basins(basins, **settings)
+
+    def _init_after_fork():
+        global _default
+        # Engines inherited from the master process would share its sockets: drop them without closing them
+        _default = None
+        _basins.clear()
+        _init()
+
+    if postfork:
+        postfork(_init_after_fork)
+    else:
+        _init()
+    return [b['name'] for b in basins]
@@ -0,0 +1,248 @@
+# encoding: utf-8
+"""
+Publication events. The publication script sends a PostgreSQL NOTIFY on the `hyfaa_publication` channel after each
+state update (see scripts/hyfaa_netcdf2DB.py _notify_publication), with a JSON payload giving the schema, the table,
+the published date range and the new state.
+Each API worker runs a listener thread per basin (on the basin's primary DB, notifications are not sent to the read
+replicas), that evicts the affected cache entries as soon as a publication is notified. Other components can register
+their own callbacks, see add_listener().
+The heavier post-publication tasks (e.g. pre-warming the caches with the most requested stations) are run by a single
+background thread per worker, once per publication run, see add_post_publication_task().
+The Server-Sent Events stream is served by the ASGI deployment, that has its own listener (see async_events.py).
+"""
+from os import environ, path
+import fcntl
+import json
+import logging
+import os
+import select
+import threading
+import time
+
+from . import database, exports, minibasin, regions, state, stations, tiles
+
+try:
+    # only available when running under uwsgi
+    from uwsgidecorators import postfork
+except ImportError:
+    postfork = None
+
+STORAGE_PATH = environ.get('STORAGE_PATH')
+NOTIFY_CHANNEL = 'hyfaa_publication'
+# Delay (s) between two reconnection attempts of a listener
+RECONNECT_DELAY = 10
+# Timeout (s) of a wait for notifications. Only bounds the time needed to stop a listener
+POLL_TIMEOUT = 5
+# Delay (s) without new notification of a basin before running its post-publication tasks, so that the notifications
+# of a publication run (one per dataserie) trigger them only once
+POST_PUBLICATION_DELAY = 10
+
+# Callbacks called on each publication event, with arguments (basin, event). Called from the listener threads
+_listeners = []
+_threads = dict()
+_stopping = threading.Event()
+# Post-publication tasks fn(basin), and the basins they are pending for: {basin: time of the last notification}
+_post_publication_tasks = []
+_pending = dict()
+_pending_condition = threading.Condition()
+_post_publication_thread = None
+
+
+def add_listener(fn):
+    """
+    Register a function to call on each publication event, with arguments (basin, event). event is the notification
+    payload (dict: schema, table, first_date, last_date, last_updated_jd, last_updated_without_errors_jd,
+    update_errors). Called from the listener threads: it must be quick, and thread-safe
+    """
+    _listeners.append(fn)
+
+
+def dispatch(basin, event):
+    for fn in _listeners:
+        try:
+            fn(basin, event)
+        except Exception as error:
+            logging.warning("Error handling the publication event {}: {}".format(event, error))
+
+
+def invalidate_caches(basin, event):
+    """
+    Evict the cache entries affected by a publication: the state (read again from the primary DB, hence the data
+    version), and the entries of the published dataserie. The read replicas are checked again before being used
+    """
+    database.set_current_basin(basin)
+    database.get_database(basin).invalidate_replicas_status()
+    try:
+        state.refresh()
+    except Exception as error:
+        logging.warning("Could not read the state from the primary DB: {}".format(error))
+        state.invalidate(basin)
+    datatype = event.get('table', '').replace('data_', '')
+    nb = minibasin.evict(basin, datatype) + tiles.evict(basin, datatype) + regions.evict(basin, datatype)
+    logging.info("Publication of {} ({}): evicted {} cache entries".format(event.get('table'), basin or 'default', nb))
+
+
+def warm_up(basin, nb_stations):
+    """
+    Pre-load the data of the nb_stations most requested stations (all the dataseries, default duration)
+    """
+    tic = time.perf_counter()
+    database.set_current_basin(basin)
+    ids = stations.get_most_requested(basin, nb_stations)
+    for id in ids:
+        stations.get_data(id, 'all', {})
+    logging.info("Warmed up {} stations ({}) in {:.1f}s".format(len(ids), basin or 'default',
+                                                                time.perf_counter() - tic))
+
+
+def once_across_workers(name, fn):
+    """
+    Wrap a post-publication task fn(basin), so that it is only run by one worker at a time: the task is skipped if
+    another worker is running it (lock file in STORAGE_PATH). Meant for the tasks writing in STORAGE_PATH (tiles
+    seeding, static exports), that the other workers then read. Run by every worker if STORAGE_PATH is not set
+    """
+    def task(basin):
+        if not STORAGE_PATH:
+            return fn(basin)
+        lock_dir = path.join(STORAGE_PATH, 'locks')
+        os.makedirs(lock_dir, exist_ok=True)
+        with open(path.join(lock_dir, '{}-{}.lock'.format(name, basin or 'default')), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                logging.info("{} ({}) is run by another worker".format(name, basin or 'default'))
+                return None
+            try:
+                return fn(basin)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    task.__name__ = name
+    return task
+
+
+def add_post_publication_task(fn):
+    """
+    Register a function to call after the publications, with the basin as argument. Called from the post-publication
+    thread, once per publication run: the notifications of a basin are coalesced until there is none for
+    POST_PUBLICATION_DELAY seconds
+    """
+    _post_publication_tasks.append(fn)
+
+
+def schedule_post_publication(basin, event=None):
+    with _pending_condition:
+        _pending[basin] = time.monotonic()
+        _pending_condition.notify()
+
+
+def _run_post_publication_tasks():
+    while not _stopping.is_set():
+        with _pending_condition:
+            now = time.monotonic()
+            ready = [b for b, t in _pending.items() if now - t >= POST_PUBLICATION_DELAY]
+            if not ready:
+                _pending_condition.wait(POST_PUBLICATION_DELAY if _pending else POLL_TIMEOUT)
+                continue
+            basin = ready[0]
+            del _pending[basin]
+        for fn in _post_publication_tasks:
+            try:
+                database.set_current_basin(basin)
+                fn(basin)
+            except Exception as error:
+                logging.warning("Post-publication task {} ({}) failed: {}".format(
+                    getattr(fn, '__name__', fn), basin or 'default', error))
+
+
+class Listener(threading.Thread):
+    """
+    Listens to the publication notifications of a basin's DB, and dispatches the events of the basin's schema
+    """
+    def __init__(self, basin):
+        super().__init__(name='hyfaa-events-{}'.format(basin or 'default'), daemon=True)
+        self.basin = basin
+
+    def _connect(self):
+        db = database.get_database(self.basin)
+        proxy = db.engine.raw_connection()
+        # keep the connection out of the pool: it is dedicated to this listener
+        proxy.detach()
+        dbapi_connection = proxy.connection
+        dbapi_connection.autocommit = True
+        cursor = dbapi_connection.cursor()
+        cursor.execute('LISTEN {}'.format(NOTIFY_CHANNEL))
+        cursor.close()
+        return dbapi_connection, db.schemas['schema']
+
+    def run(self):
+        while not _stopping.is_set():
+            dbapi_connection = None
+            try:
+                dbapi_connection, schema = self._connect()
+                logging.info("Listening to the publication events ({})".format(self.basin or 'default'))
+                while not _stopping.is_set():
+                    if select.select([dbapi_connection], [], [], POLL_TIMEOUT) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notify = dbapi_connection.notifies.pop(0)
+                        event = json.loads(notify.payload)
+                        if event.get('schema') == schema:
+                            dispatch(self.basin, event)
+            except Exception as error:
+                logging.warning("Publication events listener ({}) error: {}. Reconnecting in {}s".format(
+                    self.basin or 'default', error, RECONNECT_DELAY))
+                _stopping.wait(RECONNECT_DELAY)
+            finally:
+                if dbapi_connection is not None:
+                    try:
+                        dbapi_connection.close()
+                    except Exception:
+                        pass
+
+
+def start(basins):
+    """
+    Start a listener thread for each basin (None for the default DB), and the post-publication thread
+    """
+    global _post_publication_thread
+    _stopping.clear()
+    for basin in basins:
+        if basin not in _threads or not _threads[basin].is_alive():
+            _threads[basin] = Listener(basin)
+            _threads[basin].start()
+    if _post_publication_tasks and (_post_publication_thread is None or not _post_publication_thread.is_alive()):
+        _post_publication_thread = threading.Thread(target=_run_post_publication_tasks,
+                                                    name='hyfaa-post-publication', daemon=True)
+        _post_publication_thread.start()
+
+
+def stop():
+    _stopping.set()
+
+
+def init_app(app):
+    """
+    Start the listeners, if EVENTS_ENABLED. Under uwsgi, they are started in each worker, after the fork.
+    Must be called after database.init_app
+    """
+    if str(app.config.get('EVENTS_ENABLED', False)).lower() not in ['true', '1', 'yes']:
+        return
+    add_listener(invalidate_caches)
+    nb_warmup_stations = int(app.config.get('EVENTS_WARMUP_STATIONS') or 0)
+    if nb_warmup_stations:
+        add_post_publication_task(lambda basin: warm_up(basin, nb_warmup_stations))
+    if exports.EXPORTS_ON_PUBLISH:
+        add_post_publication_task(once_across_workers('export-static', exports.export))
+    if tiles.TILES_SEED_ON_PUBLISH:
+        add_post_publication_task(once_across_workers(
+            'seed-tiles', lambda basin: tiles.seed(tiles.TILES_SEED_ON_PUBLISH)))
+    add_listener(schedule_post_publication)
+
+    def _start():
+        start([None] + database.get_basins())
+
+    if postfork:
+        postfork(_start)
+    else:
+        _start()
@@ -0,0 +1,122 @@
+# encoding: utf-8
+"""
+Pre-rendered static exports of the most requested responses: the stations list and GeoJSON, and the `all` data of
+each station for the default duration. They are rendered after a publication (`flask export-static`), gzipped, in
+a versioned folder:
+    EXPORTS_PATH/<basin>/<version>/stations.json.gz
+    EXPORTS_PATH/<basin>/<version>/stations/as_geojson.json.gz
+    EXPORTS_PATH/<basin>/<version>/stations/<id>/data/all.json.gz
+and EXPORTS_PATH/<basin>/current, a symlink to the latest version, is switched atomically once it is complete.
+They can be served directly by a reverse proxy, or by the app (see get_file()), which falls back on the dynamic
+responses if they are missing or outdated.
+"""
+from os import environ, path
+import gzip
+import json
+import logging
+import os
+import shutil
+import time
+
+from . import database, state, stations
+
+STORAGE_PATH = environ.get('STORAGE_PATH')
+EXPORTS_PATH = environ.get('EXPORTS_PATH') or (path.join(STORAGE_PATH, 'exports') if STORAGE_PATH else None)
+# Number of previous versions kept, for the requests being served from them during the switch
+EXPORTS_KEEP_VERSIONS = 1
+# Render the exports after each publication (needs EVENTS_ENABLED, see events.py)
+EXPORTS_ON_PUBLISH = environ.get('EXPORTS_ON_PUBLISH', 'false').lower() in ['true', '1', 'yes']
+# Age (s) after which the temporary folder of an export is considered left by a crashed export, and purged
+EXPORTS_STALE_TMP_AGE = 3600
+
+
+def _basin_root(basin):
+    return path.join(EXPORTS_PATH, basin or 'default')
+
+
+def _write(root, relpath, data):
+    filepath = path.join(root, relpath + '.gz')
+    os.makedirs(path.dirname(filepath), exist_ok=True)
+    with open(filepath, 'wb') as f:
+        f.write(gzip.compress(json.dumps(data, separators=(',', ':')).encode('utf-8'), compresslevel=9))
+
+
+def _switch_current(basin_root, version):
+    """
+    Point the `current` symlink to the version folder, atomically
+    """
+    tmp_link = path.join(basin_root, 'current.tmp-{}'.format(os.getpid()))
+    if path.lexists(tmp_link):
+        os.remove(tmp_link)
+    os.symlink(version, tmp_link)
+    os.replace(tmp_link, path.join(basin_root, 'current'))
+
+
+def _purge(basin_root, keep):
+    """
+    Remove the versions not in keep. The temporary folders of the exports in progress (possibly of another process)
+    are left alone, unless they are older than EXPORTS_STALE_TMP_AGE
+    """
+    versions = [d for d in os.listdir(basin_root) if d != 'current' and path.isdir(path.join(basin_root, d))
+                and not path.islink(path.join(basin_root, d))]
+    for d in versions:
+        if d in keep:
+            continue
+        if '.tmp-' in d:
+            try:
+                if time.time() - path.getmtime(path.join(basin_root, d)) < EXPORTS_STALE_TMP_AGE:
+                    continue
+            except OSError:
+                continue
+        shutil.rmtree(path.join(basin_root, d), ignore_errors=True)
+
+
+def export(basin=None):
+    """
+    Render the static exports of a basin (None for the default DB), for the current data version
+    Returns the version, or None if EXPORTS_PATH is not configured
+    """
+    if not EXPORTS_PATH:
+        logging.warning("Neither EXPORTS_PATH nor STORAGE_PATH is set: static exports are disabled")
+        return None
+    tic = time.perf_counter()
+    database.set_current_basin(basin)
+    # from the primary DB, the read replicas might not have caught up with the publication yet
+    state.refresh()
+    version = state.get_data_version()
+    basin_root = _basin_root(basin)
+    if path.isdir(path.join(basin_root, version)):
+        logging.info("Static exports of {} are up to date ({})".format(basin or 'default', version))
+        return version
+
+    tmp_root = path.join(basin_root, '{}.tmp-{}'.format(version, os.getpid()))
+    shutil.rmtree(tmp_root, ignore_errors=True)
+    stations_list = stations.get_stations()
+    _write(tmp_root, 'stations.json', stations_list)
+    _write(tmp_root, 'stations/as_geojson.json', stations.get_stations_as_geojson())
+    for st in stations_list:
+        _write(tmp_root, 'stations/{}/data/all.json'.format(st['id']), stations.get_data(st['id'], 'all', {}))
+    os.replace(tmp_root, path.join(basin_root, version))
+    previous = os.readlink(path.join(basin_root, 'current')) if path.islink(path.join(basin_root, 'current')) else None
+    _switch_current(basin_root, version)
+    _purge(basin_root, keep=[version, previous][:1 + EXPORTS_KEEP_VERSIONS])
+    logging.info("Exported {} stations of {} ({}) in {:.1f}s".format(len(stations_list), basin or 'default', version,
+                                                                     time.perf_counter() - tic))
+    return version
+
+
+def get_file(relpath):
+    """
+    Get the path of the gzipped static export of the current basin, e.g. get_file('stations.json'), if it exists and
+    is up to date (rendered from the current data version). Returns None otherwise
+    """
+    if not EXPORTS_PATH:
+        return None
+    current = path.join(_basin_root(database.current_basin()), 'current')
+    try:
+        if os.readlink(current) != state.get_data_version():
+            return None
+    except OSError:
+        return None
+    filepath = path.join(current, relpath + '.gz')
+    return filepath if path.isfile(filepath) else None
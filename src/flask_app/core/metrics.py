@@ -0,0 +1,124 @@
+"""
+Prometheus metrics. Can be used independently from Flask (see ../monitoring.py for the Flask side)
+prometheus_client is optional: if it is not installed, the metrics are simply not collected.
+
+When running several processes (uwsgi workers), set the PROMETHEUS_MULTIPROC_DIR env. var to an empty, writable
+folder, so that the metrics are aggregated across the processes
+"""
+from os import environ
+import logging
+import re
+import time
+
+from sqlalchemy import event
+
+try:
+    import prometheus_client
+    from prometheus_client import Counter, Gauge, Histogram
+except ImportError:
+    prometheus_client = None
+
+enabled = False
+
+REQUEST_LATENCY = None
+RESPONSE_SIZE = None
+SQL_LATENCY = None
+POOL_CHECKOUT_WAIT = None
+POOL_IN_USE = None
+CACHE_REQUESTS = None
+COALESCED_REQUESTS = None
+
+_whitespaces = re.compile(r'\s+')
+
+
+def init_metrics():
+    """
+    Create the metrics. Returns False if prometheus_client is not available
+    """
+    global enabled, REQUEST_LATENCY, RESPONSE_SIZE, SQL_LATENCY, POOL_CHECKOUT_WAIT, POOL_IN_USE, CACHE_REQUESTS, \
+        COALESCED_REQUESTS
+    if enabled:
+        return True
+    if prometheus_client is None:
+        logging.warning("prometheus_client is not installed: metrics are disabled")
+        return False
+    REQUEST_LATENCY = Histogram('hyfaa_http_request_duration_seconds', 'HTTP requests latency',
+                                ['method', 'endpoint', 'status'])
+    RESPONSE_SIZE = Histogram('hyfaa_http_response_size_bytes', 'HTTP responses size', ['endpoint'],
+                              buckets=[100, 1000, 10000, 100000, 1000000, 10000000])
+    SQL_LATENCY = Histogram('hyfaa_sql_query_duration_seconds', 'SQL queries execution time', ['query'])
+    POOL_CHECKOUT_WAIT = Histogram('hyfaa_db_pool_checkout_wait_seconds', 'Time waited to check out a DB connection',
+                                   ['engine'])
+    POOL_IN_USE = Gauge('hyfaa_db_pool_connections_in_use', 'DB connections currently checked out from the pool',
+                        ['engine'], multiprocess_mode='livesum')
+    CACHE_REQUESTS = Counter('hyfaa_cache_requests_total', 'Cache lookups', ['cache', 'result'])
+    COALESCED_REQUESTS = Counter('hyfaa_coalesced_requests_total',
+                                 'Lookups served by a concurrent identical lookup (see singleflight.py)',
+                                 ['group', 'scope'])
+    enabled = True
+    return True
+
+
+def _query_label(statement):
+    # Queries are static, with bound parameters: the statement itself is a bounded label
+    return _whitespaces.sub(' ', statement).strip()[:120]
+
+
+def instrument_engine(engine, name):
+    """
+    Collect the SQL queries time and the pool usage of a SQLAlchemy engine
+    """
+    if not enabled:
+        return
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info['query_start_time'].pop(-1)
+        SQL_LATENCY.labels(_query_label(statement)).observe(elapsed)
+
+    @event.listens_for(engine, 'checkout')
+    def checkout(dbapi_connection, connection_record, connection_proxy):
+        POOL_IN_USE.labels(name).inc()
+
+    @event.listens_for(engine, 'checkin')
+    def checkin(dbapi_connection, connection_record):
+        POOL_IN_USE.labels(name).dec()
+
+
+def observe_checkout(engine_name, wait_time):
+    if enabled:
+        POOL_CHECKOUT_WAIT.labels(engine_name).observe(wait_time)
+
+
+def record_cache_lookup(cache_name, hit):
+    """
+    Count a cache lookup (hit or miss), for the cache hit rates
+    """
+    if enabled:
+        CACHE_REQUESTS.labels(cache_name, 'hit' if hit else 'miss').inc()
+
+
+def record_coalesced(group, scope):
+    """
+    Count a lookup that was served by a concurrent identical lookup, in the same worker (scope `worker`) or in
+    another one (scope `host`)
+    """
+    if enabled:
+        COALESCED_REQUESTS.labels(group, scope).inc()
+
+
+def generate_latest():
+    """
+    Returns the metrics in Prometheus text format, and the corresponding content type
+    """
+    if environ.get('PROMETHEUS_MULTIPROC_DIR') or environ.get('prometheus_multiproc_dir'):
+        from prometheus_client import multiprocess
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return prometheus_client.generate_latest(registry), prometheus_client.CONTENT_TYPE_LATEST
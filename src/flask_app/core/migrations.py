@@ -0,0 +1,256 @@
+# encoding: utf-8
+"""
+Serving indexes: the indexes the API queries rely on, declared here so that they are owned by the backend.
+apply() creates the missing ones (CREATE INDEX CONCURRENTLY, so the tables stay writable by the publication script),
+and rebuilds the ones left invalid by a failed concurrent build. check() runs the statements of the API query paths
+with auto_explain, to get the plans of the queries they actually run (including the ones nested in the
+get_*_values_for_minibasin functions), and flags the plans that don't use an index anymore.
+Both are run through the Flask CLI (see ../cli.py), on the current basin's DB.
+"""
+import json
+import logging
+import time
+
+from sqlalchemy.exc import DBAPIError
+
+from . import database, minibasin, stations
+from .minibasin import MINIBASINS_TABLE
+
+# Columns served by the API (get_*_values_for_minibasin functions, tiles, regions), included in the covering indexes
+_served_columns = {
+    'data_mgbstandard': ['flow_mean', 'elevation_mean'],
+    'data_assimilated': ['flow_median', 'flow_mad', 'elevation_median'],
+    'data_forecast': ['flow_median', 'flow_mad', 'elevation_median'],
+}
+
+# Index definitions. `schema` is the schema the index is created in (the table's)
+indexes = []
+for _table, _columns in _served_columns.items():
+    indexes += [
+        {
+            # minibasin time series: index-only scans on (cell_id, date range)
+            'schema': '{schema}',
+            'name': '{}_cell_date_cov_idx'.format(_table),
+            'definition': 'ON {{schema}}.{table} (cell_id, date) INCLUDE ({columns})'.format(
+                table=_table, columns=', '.join(_columns)),
+        },
+        {
+            # date ranges over all the cells (latest date, tiles, regions, retention). Tiny, since the rows are
+            # inserted in date order
+            'schema': '{schema}',
+            'name': '{}_date_brin_idx'.format(_table),
+            'definition': 'ON {{schema}}.{table} USING brin (date)'.format(table=_table),
+        },
+        {
+            # incremental queries (`since` parameter): rows of a cell updated after a given time
+            'schema': '{schema}',
+            'name': '{}_cell_update_time_idx'.format(_table),
+            'definition': 'ON {{schema}}.{table} (cell_id, update_time)'.format(table=_table),
+        },
+    ]
+indexes += [
+    {
+        # alerts: stations of a minibasin
+        'schema': '{geo_schema}',
+        'name': 'stations_minibasin_idx',
+        'definition': 'ON {geo_schema}.stations (minibasin)',
+    },
+    {
+        # tiles, nearby search KNN fallback, regions
+        'schema': MINIBASINS_TABLE.split('.')[0] if '.' in MINIBASINS_TABLE else 'public',
+        'name': '{}_geom_idx'.format(MINIBASINS_TABLE.split('.')[-1]),
+        'definition': 'ON {} USING gist (wkb_geometry)'.format(MINIBASINS_TABLE),
+    },
+]
+
+# Query paths checked by check(): {name: (statement the API runs, params query, tables that must not be sequentially
+# scanned)}
+checks = {
+    'stations.get_station': (
+        database.statement_query(stations._station_statement),
+        "SELECT id FROM {geo_schema}.stations LIMIT 1",
+        ['stations'],
+    ),
+}
+for _table in _served_columns:
+    _serie = _table.replace('data_', '')
+    checks['minibasin.get_{}_values'.format(_serie)] = (
+        database.statement_query(minibasin._statements[_serie]),
+        "SELECT cell_id AS id, '{}' AS duration FROM {{schema}}.{} LIMIT 1".format(minibasin.defaults['duration'],
+                                                                                  _table),
+        [_table],
+    )
+    checks['minibasin.get_{}_changes'.format(_serie)] = (
+        minibasin._changes_queries[_serie],
+        "SELECT cell_id AS id, max(update_time) - interval '1 day' AS since FROM {{schema}}.{} "
+        "WHERE cell_id = (SELECT cell_id FROM {{schema}}.{} LIMIT 1) GROUP BY cell_id".format(_table, _table),
+        [_table],
+    )
+
+
+def _index_status(conn, schema, name):
+    """
+    Returns None if the index doesn't exist, else whether it is valid
+    """
+    row = conn.execute(database.sql(
+        "SELECT i.indisvalid FROM pg_index i WHERE i.indexrelid = to_regclass(:name)"),
+        name='{}.{}'.format(schema, name)).fetchone()
+    return row[0] if row else None
+
+
+def apply(dry_run=False):
+    """
+    Create the missing serving indexes on the current basin's DB, and rebuild the invalid ones
+    Returns the list of the (re)built indexes
+    """
+    db = database.get_database()
+    built = []
+    with database.connect(read_only=False) as conn:
+        # CREATE INDEX CONCURRENTLY can't run in a transaction
+        conn = conn.execution_options(isolation_level='AUTOCOMMIT')
+        for index in indexes:
+            schema = db.format(index['schema'])
+            status = _index_status(conn, schema, index['name'])
+            if status:
+                continue
+            statements = []
+            if status is False:
+                # left invalid by a failed concurrent build
+                statements.append('DROP INDEX CONCURRENTLY IF EXISTS {}.{}'.format(schema, index['name']))
+            statements.append('CREATE INDEX CONCURRENTLY IF NOT EXISTS {} {}'.format(index['name'], index['definition']))
+            for statement in statements:
+                statement = db.format(statement)
+                logging.info(statement)
+                if not dry_run:
+                    tic = time.perf_counter()
+                    conn.execute(statement)
+                    logging.info("Done in {:.1f}s".format(time.perf_counter() - tic))
+            built.append('{}.{}'.format(schema, index['name']))
+    return built
+
+
+def _plan_nodes(plan):
+    yield plan
+    for child in plan.get('Plans', []):
+        yield from _plan_nodes(child)
+
+
+def check(analyze=False):
+    """
+    Run the API query paths on the current basin's DB, with auto_explain logging the plans of all the queries they
+    run (nested ones included) to the client. A query path is flagged if one of its plans sequentially scans one of
+    the tables it should access through an index. Sequential scans are disabled while planning (the planner prefers
+    them on small tables), so that they only show up when no index can serve the query.
+    auto_explain must be loadable by the DB role (superuser, or auto_explain in session_preload_libraries). If it
+    isn't, the statements are only EXPLAINed: the plans of the queries nested in the DB functions are then unavailable
+    (`warning` in the results)
+    Returns a list of dicts: {name, ok, cost, time (if analyze), indexes (used), seq_scans (flagged tables), warning}
+    """
+    with database.connect() as conn:
+        trans = conn.begin()
+        try:
+            nested_plans = _load_auto_explain(conn)
+            # SET LOCAL: rolled back with the transaction, even if a query failed
+            settings = ["enable_seqscan = off"]
+            if nested_plans:
+                settings += ["client_min_messages = log",
+                             "auto_explain.log_min_duration = 0", "auto_explain.log_nested_statements = on",
+                             "auto_explain.log_format = 'json'",
+                             "auto_explain.log_analyze = {}".format('on' if analyze else 'off')]
+            for setting in settings:
+                conn.execute(database.sql("SET LOCAL {}".format(setting)))
+            if nested_plans:
+                return _explain_checks(conn, analyze)
+            return _plain_explain_checks(conn, analyze)
+        finally:
+            trans.rollback()
+
+
+def _load_auto_explain(conn):
+    """
+    Load auto_explain in the session. Returns False if the DB role isn't allowed to
+    """
+    savepoint = conn.begin_nested()
+    try:
+        conn.execute(database.sql("LOAD 'auto_explain'"))
+    except DBAPIError as error:
+        savepoint.rollback()
+        logging.warning("Could not load auto_explain, the nested plans are unavailable: {}".format(
+            str(error.orig).strip()))
+        return False
+    savepoint.commit()
+    return True
+
+
+def _logged_plans(notices):
+    """
+    Parse the plans logged by auto_explain. Returns a list of (duration (ms), plan) tuples
+    """
+    plans = []
+    for notice in notices:
+        if 'plan:' not in notice:
+            continue
+        header, plan = notice.split('plan:', 1)
+        try:
+            duration = float(header.split('duration:')[1].split('ms')[0])
+        except (IndexError, ValueError):
+            duration = None
+        plans.append((duration, json.loads(plan)))
+    return plans
+
+
+def _explain_checks(conn, analyze):
+    results = []
+    dbapi_connection = conn.connection.connection
+    for name, (query, params_query, tables) in checks.items():
+        params = conn.execute(database.sql(params_query)).fetchone()
+        if params is None:
+            results.append({'name': name, 'ok': True, 'skipped': 'no data'})
+            continue
+        del dbapi_connection.notices[:]
+        conn.execute(database.sql(query), **dict(params)).fetchall()
+        plans = _logged_plans(dbapi_connection.notices)
+        if not plans:
+            results.append({'name': name, 'ok': False, 'skipped': 'no plan logged (is auto_explain loaded?)'})
+            continue
+        results.append(_plans_result(name, plans, tables, analyze))
+    return results
+
+
+def _plain_explain_checks(conn, analyze):
+    """
+    EXPLAIN the statements themselves, without the plans of the queries nested in the DB functions
+    """
+    results = []
+    for name, (query, params_query, tables) in checks.items():
+        params = conn.execute(database.sql(params_query)).fetchone()
+        if params is None:
+            results.append({'name': name, 'ok': True, 'skipped': 'no data'})
+            continue
+        explain = 'EXPLAIN (FORMAT JSON, ANALYZE {}) '.format('on' if analyze else 'off')
+        plan = conn.execute(database.sql(explain + query), **dict(params)).scalar()[0]
+        result = _plans_result(name, [(plan.get('Execution Time'), plan)], tables, analyze)
+        result['warning'] = 'nested plans unavailable (auto_explain could not be loaded): only the statement is checked'
+        results.append(result)
+    return results
+
+
+def _plans_result(name, plans, tables, analyze):
+    """
+    Check result of a statement, from its plans (list of (duration (ms), plan) tuples, the statement itself last)
+    """
+    nodes = [n for duration, plan in plans for n in _plan_nodes(plan['Plan'])]
+    seq_scans = sorted(set([n['Relation Name'] for n in nodes
+                            if n['Node Type'] == 'Seq Scan' and n.get('Relation Name') in tables]))
+    # the statement itself is logged last, once its nested queries are done
+    duration, plan = plans[-1]
+    result = {
+        'name': name,
+        'ok': not seq_scans,
+        'cost': plan['Plan']['Total Cost'],
+        'indexes': sorted(set([n['Index Name'] for n in nodes if n.get('Index Name')])),
+        'seq_scans': seq_scans,
+    }
+    if analyze:
+        result['time'] = duration
+    return result
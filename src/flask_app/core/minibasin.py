@@ -2,13 +2,66 @@
 """
 Functions related to minibasins
 """
-from .database import engine
-from sqlalchemy import text
+from datetime import datetime, timedelta, timezone
+from os import environ
+import re
+
+from . import database, state
+from .cache import LRUCache
+from .singleflight import SingleFlight
+
+# Number of minibasin data lookups kept in memory (per worker), keyed by the data version
+DATA_CACHE_SIZE = int(environ.get('DATA_CACHE_SIZE', 256))
+# Minibasins geometries table (columns `id` and `wkb_geometry`, EPSG:4326). Might use the schemas placeholders (see
+# database.sql())
+MINIBASINS_TABLE = environ.get('MINIBASINS_TABLE', '{geo_schema}.minibasins')
 
 _accepted_datatypes = ['all', 'assimilated', 'mgbstandard', 'forecast']
+_dataseries = ['assimilated', 'mgbstandard', 'forecast']
 defaults = {
     'duration': '1 year'
 }
+# textual representation of a PostgreSQL time interval, restricted to what we accept as duration
+_duration_pattern = re.compile('(([0-9]+) (year|month|week|day)(s)?( )?)+')
+
+
+def is_valid_duration(value):
+    """
+    Check that the given value is a duration we accept, e.g. '1 year 30 days'
+    """
+    return bool(_duration_pattern.fullmatch(value))
+
+
+_statements = {
+    serie: database.declare_statement(
+        'get_{}_values'.format(serie),
+        'SELECT {{schema}}.get_{}_values_for_minibasin(:id, :duration)'.format(serie),
+        ['id', 'duration'])
+    for serie in ['mgbstandard', 'forecast', 'assimilated']
+}
+
+# Columns returned by the incremental queries (see get_changes()), named as in the get_*_values_for_minibasin functions
+# output
+_changes_columns = {
+    'mgbstandard': {'flow': 'flow_mean'},
+    'assimilated': {'flow': 'flow_median', 'flow_mad': 'flow_mad'},
+    'forecast': {'flow': 'flow_median', 'flow_mad': 'flow_mad'},
+}
+_changes_queries = {
+    serie: """
+        SELECT date, update_time, {columns} FROM {{schema}}.data_{serie}
+        WHERE cell_id = :id AND update_time >= :since
+        ORDER BY date
+    """.format(serie=serie, columns=', '.join([c if c == name else '{} AS {}'.format(c, name)
+                                                for name, c in columns.items()]))
+    for serie, columns in _changes_columns.items()
+}
+# Publication progress of the dataseries: time the data of their latest error-free run was added (update_time of its
+# rows). Written by the publication script once all the rows of the run are committed
+_published_query = "SELECT tablename, last_updated_without_errors_jd FROM {schema}.state"
+
+_flights = SingleFlight('minibasin_data')
+_cache = LRUCache('minibasin_data', DATA_CACHE_SIZE)
 
 
 def get_data(id, datatype, opts):
@@ -19,6 +72,8 @@ def get_data(id, datatype, opts):
       * datatype: should be one of _accepted_datatypes values
       * opts: filtering options
         * duration: Time lapse to retrieve. Should be consistent with the textual representation of a PostgreSQL date/time interval (https://www.postgresql.org/docs/9.1/datatype-datetime.html). Default is '1 year'
+        * since: if set (datetime, or dict {dataserie: datetime}), only retrieve the rows updated since this time, see
+          get_changes(). duration is then ignored
     """
     # read options
     duration = opts.get('duration') or defaults['duration']
@@ -30,6 +85,8 @@ def get_data(id, datatype, opts):
                    'data': dict(),
                    'error': 'datatype not recognized. Should be one of `{}`'.format(', '.join(_accepted_datatypes))
                }
+    if opts.get('since'):
+        return get_changes(id, datatype, opts['since'])
 
     if datatype in ['all', 'assimilated']:
         values['assimilated'] = _get_assimilated_data(id, duration)
@@ -41,22 +98,35 @@ def get_data(id, datatype, opts):
 
 
 def _get_mgbstandard_data(minibasin_id, duration='1 year'):
-    json_output = {'error': 'no result'}
-    with engine.connect() as conn:
-        query = text("SELECT hyfaa.get_mgbstandard_values_for_minibasin(:id, :duration)")
-        rs = conn.execute(query, id=minibasin_id, duration=duration)
-        mini_record = rs.fetchone()
-        if mini_record:
-            json_output = mini_record[0]
-    return json_output
+    return _get_serie_data('mgbstandard', minibasin_id, duration)
 
 
 def _get_forecast_data(minibasin_id, duration='1 year'):
+    return _get_serie_data('forecast', minibasin_id, duration)
+
+
+def _get_assimilated_data(minibasin_id, duration='1 year'):
+    return _get_serie_data('assimilated', minibasin_id, duration)
+
+
+def _get_serie_data(serie, minibasin_id, duration='1 year'):
     """
+    Cached until the next publication of the serie. Concurrent identical lookups (same basin, serie, minibasin and
+    duration) share a single DB query
     """
+    version = state.get_data_version(['data_{}'.format(serie)])
+    key = (database.current_basin(), serie, minibasin_id, duration, version)
+    json_output = _cache.get(key)
+    if json_output is None:
+        json_output = _flights.do(key, _query_serie_data, serie, minibasin_id, duration)
+        _cache.set(key, json_output)
+    return json_output
+
+
+def _query_serie_data(serie, minibasin_id, duration):
     json_output = {'error': 'no result'}
-    with engine.connect() as conn:
-        query = text("SELECT hyfaa.get_forecast_values_for_minibasin(:id, :duration)")
+    with database.connect() as conn:
+        query = database.statement(_statements[serie])
         rs = conn.execute(query, id=minibasin_id, duration=duration)
         mini_record = rs.fetchone()
         if mini_record:
@@ -64,14 +134,69 @@ def _get_forecast_data(minibasin_id, duration='1 year'):
     return json_output
 
 
-def _get_assimilated_data(minibasin_id, duration='1 year'):
+def _julianday_to_datetime(jd):
+    # same conversion as the publication script's, for the update_time column
+    return datetime(1950, 1, 1) + timedelta(int(jd))
+
+
+def _published_marks(conn):
     """
+    {dataserie: update time up to which the dataserie is fully published}, for the published dataseries
     """
-    json_output = {'error': 'no result'}
-    with engine.connect() as conn:
-        query = text("SELECT hyfaa.get_assimilated_values_for_minibasin(:id, :duration)")
-        rs = conn.execute(query, id=minibasin_id, duration=duration)
-        mini_record = rs.fetchone()
-        if mini_record:
-            json_output = mini_record[0]
-    return json_output
+    rs = conn.execute(database.sql(_published_query))
+    return {row[0].replace('data_', ''): _julianday_to_datetime(row[1]) for row in rs.fetchall()
+            if row[0].replace('data_', '') in _dataseries and row[1]}
+
+
+def get_changes(id, datatype, since):
+    """
+    Retrieve the rows of the given minibasin updated (published) since a given time, for polling clients that already
+    have the older ones. Not cached: the queries are served by the (cell_id, update_time) indexes (see migrations.py).
+    The `expected` values are not returned (they barely change from one publication to the next).
+    `since` is a datetime, or a dict {dataserie: datetime} (the dataseries missing from it are fully returned).
+    Returns the data, and the high-water mark of each dataserie, to use as `since` in the next request. The marks
+    follow the publication progress (state table), not the returned rows: a dataserie's rows are committed in pages,
+    so its mark only moves once the publication is complete. update_time is day-truncated, and a run can add rows with
+    the same update_time as the previous one, hence the `>=`: the rows updated on the mark's day are returned again
+    by the next request, and the clients replace the values by date
+    """
+    if not isinstance(since, dict):
+        since = {serie: since for serie in _dataseries}
+    values = dict()
+    sinces = dict()
+    high_water_marks = dict()
+    with database.connect() as conn:
+        # read before the data: the rows of the runs it reports are committed
+        published = _published_marks(conn)
+        for serie in _dataseries:
+            if datatype not in ['all', serie]:
+                continue
+            serie_since = since.get(serie) or datetime.min
+            if serie_since.tzinfo is not None:
+                # update_time is stored as UTC, without time zone
+                serie_since = serie_since.astimezone(timezone.utc).replace(tzinfo=None)
+            rows = conn.execute(database.sql(_changes_queries[serie]), id=id, since=serie_since).fetchall()
+            values[serie] = []
+            for row in rows:
+                item = {'date': row['date'].isoformat()}
+                item.update({name: row[name] for name in _changes_columns[serie]})
+                values[serie].append(item)
+            sinces[serie] = serie_since.isoformat()
+            high_water_marks[serie] = max(serie_since, published.get(serie, datetime.min)).isoformat()
+    return {'id': id, 'data': values, 'since': sinces, 'high_water_marks': high_water_marks}
+
+
+def get_high_water_marks():
+    """
+    High-water mark of each published dataserie of the current basin, to use as `since` option of get_data to only get
+    the values published from now on (see get_changes())
+    """
+    with database.connect() as conn:
+        return {serie: mark.isoformat() for serie, mark in _published_marks(conn).items()}
+
+
+def evict(basin, datatype):
+    """
+    Remove the cached lookups of a basin's dataserie
+    """
+    return _cache.evict(lambda k: k[0] == basin and k[1] == datatype)
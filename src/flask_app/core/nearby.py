@@ -0,0 +1,263 @@
+# encoding: utf-8
+"""
+Nearest-neighbours search on stations and minibasins.
+Served from an in-memory spatial index, built (per worker) from the DB geometries and refreshed every
+SPATIAL_INDEX_TTL seconds. Falls back on a PostGIS KNN query if the index can't be built (or is being built).
+The minibasins are indexed by a point on their surface: the minibasin containing the location (if any) comes first,
+with a 0 distance, then the closest ones by distance to this point, on both paths. The in-memory index also holds
+their polygons, so that it serves the requests without DB round trip.
+"""
+from os import environ
+import json
+import logging
+import threading
+import time
+
+import numpy as np
+from . import database
+from .minibasin import MINIBASINS_TABLE
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    # Brute-force search, still fast enough for a few thousand points
+    cKDTree = None
+
+SPATIAL_INDEX_TTL = int(environ.get('SPATIAL_INDEX_TTL', 3600))
+# Delay (s) before trying again to build an index, after a failure
+SPATIAL_INDEX_RETRY_DELAY = int(environ.get('SPATIAL_INDEX_RETRY_DELAY', 60))
+EARTH_RADIUS = 6371008.8
+
+_sources = {
+    'stations': {
+        'index_query': """SELECT s.id, s.minibasin, s.city,
+                            ST_X(ST_PointOnSurface(g.wkb_geometry)) AS lon, ST_Y(ST_PointOnSurface(g.wkb_geometry)) AS lat
+                          FROM {geo_schema}.stations s JOIN {geo_schema}.stations_geo g ON g.id = s.id""",
+        'knn_query': """SELECT s.id, s.minibasin, s.city,
+                          ST_Distance(g.wkb_geometry::geography, ST_SetSRID(ST_MakePoint(:lon, :lat), 4326)::geography) AS distance
+                        FROM {geo_schema}.stations s JOIN {geo_schema}.stations_geo g ON g.id = s.id
+                        ORDER BY g.wkb_geometry <-> ST_SetSRID(ST_MakePoint(:lon, :lat), 4326)
+                        LIMIT :limit""",
+        'fields': ['id', 'minibasin', 'city'],
+    },
+    'minibasins': {
+        'index_query': """SELECT id,
+                            ST_X(ST_PointOnSurface(wkb_geometry)) AS lon, ST_Y(ST_PointOnSurface(wkb_geometry)) AS lat,
+                            ST_AsGeoJSON(wkb_geometry) AS geometry
+                          FROM """ + MINIBASINS_TABLE,
+        # the candidates are preselected with the (indexed) KNN operator on the polygons, then sorted by the distance
+        # to their point on surface, as the in-memory index does
+        'knn_query': """SELECT id,
+                          ST_Distance(ST_PointOnSurface(wkb_geometry)::geography, ST_SetSRID(ST_MakePoint(:lon, :lat), 4326)::geography) AS distance
+                        FROM (
+                          SELECT id, wkb_geometry FROM """ + MINIBASINS_TABLE + """
+                          ORDER BY wkb_geometry <-> ST_SetSRID(ST_MakePoint(:lon, :lat), 4326)
+                          LIMIT :limit * 4 + 16
+                        ) candidates
+                        ORDER BY distance
+                        LIMIT :limit""",
+        'contains_query': """SELECT id FROM """ + MINIBASINS_TABLE + """
+                             WHERE ST_Contains(wkb_geometry, ST_SetSRID(ST_MakePoint(:lon, :lat), 4326))
+                             LIMIT 1""",
+        'fields': ['id'],
+    },
+}
+
+# Keyed by (basin, source)
+_indexes = dict()
+_indexes_lock = threading.Lock()
+# Keys of the indexes being built
+_building = set()
+# Time of the last failed build, per key
+_failed_at = dict()
+
+
+def _to_unit_vectors(lons, lats):
+    """
+    Convert lon/lat (degrees) into 3D unit vectors: the euclidean (chord) distance between them grows with the
+    great-circle distance, so it can be used for the nearest neighbours search
+    """
+    lons = np.radians(np.asarray(lons, dtype='f8'))
+    lats = np.radians(np.asarray(lats, dtype='f8'))
+    return np.column_stack([np.cos(lats) * np.cos(lons), np.cos(lats) * np.sin(lons), np.sin(lats)])
+
+
+def _polygons(geometry):
+    """
+    The polygons of a GeoJSON (multi)polygon, as lists of rings (arrays of lon/lat)
+    """
+    if geometry['type'] == 'Polygon':
+        coordinates = [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        coordinates = geometry['coordinates']
+    else:
+        return []
+    return [[np.asarray(ring, dtype='f8')[:, :2] for ring in polygon if ring] for polygon in coordinates]
+
+
+def _bbox(polygons):
+    """
+    Bounding box (xmin, ymin, xmax, ymax) of a list of polygons. Empty (contains nothing) if there is none
+    """
+    outer_rings = [rings[0] for rings in polygons if rings]
+    if not outer_rings:
+        return [np.inf, np.inf, -np.inf, -np.inf]
+    points = np.concatenate(outer_rings)
+    return [points[:, 0].min(), points[:, 1].min(), points[:, 0].max(), points[:, 1].max()]
+
+
+def _in_ring(ring, lon, lat):
+    """
+    Ray casting point in ring test
+    """
+    x, y = ring[:, 0], ring[:, 1]
+    x2, y2 = np.roll(x, -1), np.roll(y, -1)
+    crossing = (y > lat) != (y2 > lat)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        x_cross = x + (lat - y) * (x2 - x) / (y2 - y)
+    return bool(np.count_nonzero(crossing & (lon < x_cross)) % 2)
+
+
+class PointIndex:
+    """
+    Nearest-neighbours index on a set of lon/lat points. Optionally holds the polygons the points are in, to find the
+    one containing a location
+    """
+    def __init__(self, records, lons, lats, polygons=None):
+        self.records = records
+        self.points = _to_unit_vectors(lons, lats)
+        self.tree = cKDTree(self.points) if (cKDTree is not None and len(records)) else None
+        self.polygons = polygons
+        if polygons is not None:
+            # bounding boxes (xmin, ymin, xmax, ymax), to only test the polygons that might contain the location
+            self.bboxes = np.array([_bbox(polys) for polys in polygons], dtype='f8').reshape(-1, 4)
+        self.built_at = time.monotonic()
+
+    def nearest(self, lon, lat, limit):
+        """
+        Returns the `limit` records closest to (lon, lat), with their distance (m) in a `distance` field
+        """
+        limit = min(limit, len(self.records))
+        if limit <= 0:
+            return []
+        target = _to_unit_vectors([lon], [lat])[0]
+        if self.tree is not None:
+            chords, idx = self.tree.query(target, k=limit)
+            chords, idx = np.atleast_1d(chords), np.atleast_1d(idx)
+        else:
+            all_chords = np.linalg.norm(self.points - target, axis=1)
+            idx = np.argpartition(all_chords, limit - 1)[:limit]
+            idx = idx[np.argsort(all_chords[idx])]
+            chords = all_chords[idx]
+        distances = 2 * EARTH_RADIUS * np.arcsin(np.clip(chords / 2, 0, 1))
+        return [dict(self.records[i], distance=round(float(d), 1)) for i, d in zip(idx, distances)]
+
+    def containing(self, lon, lat):
+        """
+        Returns the record whose polygon contains (lon, lat), with a 0 distance. None if there is none, or if the index
+        has no polygons
+        """
+        if self.polygons is None:
+            return None
+        b = self.bboxes
+        candidates = np.nonzero((b[:, 0] <= lon) & (lon <= b[:, 2]) & (b[:, 1] <= lat) & (lat <= b[:, 3]))[0]
+        for i in candidates:
+            for rings in self.polygons[i]:
+                # in the outer ring, and not in a hole
+                if _in_ring(rings[0], lon, lat) and not any(_in_ring(r, lon, lat) for r in rings[1:]):
+                    return dict(self.records[i], distance=0.)
+        return None
+
+
+def _build_index(source):
+    conf = _sources[source]
+    tic = time.perf_counter()
+    with database.connect() as conn:
+        rows = conn.execute(database.sql(conf['index_query'])).fetchall()
+    rows = [r for r in rows if r['lon'] is not None and r['lat'] is not None]
+    index = PointIndex(
+        [{f: r[f] for f in conf['fields']} for r in rows],
+        [r['lon'] for r in rows],
+        [r['lat'] for r in rows],
+        [_polygons(json.loads(r['geometry'])) for r in rows] if 'contains_query' in conf else None,
+    )
+    logging.info("Built {} spatial index ({} points) in {:.3f}s".format(source, len(rows), time.perf_counter() - tic))
+    return index
+
+
+def _get_index(source):
+    """
+    Get the spatial index for the given source of the current basin, (re)build it if needed. The index is built
+    outside the lock, by the first thread finding it outdated: the others meanwhile use the outdated one, or get None
+    if there is none yet. Returns None if it can't be built. After a failure, the build is not tried again for
+    SPATIAL_INDEX_RETRY_DELAY seconds
+    """
+    key = (database.current_basin(), source)
+    index = _indexes.get(key)
+    if index is not None and time.monotonic() - index.built_at < SPATIAL_INDEX_TTL:
+        return index
+    with _indexes_lock:
+        failed_at = _failed_at.get(key)
+        if key in _building or (failed_at is not None and time.monotonic() - failed_at < SPATIAL_INDEX_RETRY_DELAY):
+            return index
+        _building.add(key)
+    try:
+        index = _build_index(source)
+        _indexes[key] = index
+    except Exception as error:
+        logging.warning("Could not build the {} spatial index: {}. Retrying in {}s at the earliest".format(
+            source, error, SPATIAL_INDEX_RETRY_DELAY))
+        _failed_at[key] = time.monotonic()
+        # keep using the outdated one, if there is one
+    finally:
+        with _indexes_lock:
+            _building.discard(key)
+    return _indexes.get(key)
+
+
+def _knn_query(source, lon, lat, limit):
+    conf = _sources[source]
+    with database.connect() as conn:
+        rows = conn.execute(database.sql(conf['knn_query']), lon=lon, lat=lat, limit=limit).fetchall()
+    return [dict({f: r[f] for f in conf['fields']}, distance=round(float(r['distance']), 1)) for r in rows]
+
+
+def _containing(source, lon, lat):
+    """
+    Get the record containing the location, if the source has polygons. None otherwise
+    """
+    conf = _sources[source]
+    if 'contains_query' not in conf:
+        return None
+    with database.connect() as conn:
+        row = conn.execute(database.sql(conf['contains_query']), lon=lon, lat=lat).fetchone()
+    return dict({f: row[f] for f in conf['fields']}, distance=0.) if row else None
+
+
+def get_nearby(source, lon, lat, limit):
+    """
+    Retrieve the records closest to a location
+    Params:
+      * source: 'stations' or 'minibasins'
+      * lon, lat: location (WGS84 coordinates)
+      * limit: max number of records to return
+    Returns a list of dicts, sorted by distance (`distance` field, in meters)
+    """
+    index = _get_index(source)
+    if index is not None:
+        records = index.nearest(lon, lat, limit)
+        containing = index.containing(lon, lat)
+    else:
+        records = _knn_query(source, lon, lat, limit)
+        containing = _containing(source, lon, lat)
+    if containing is not None:
+        records = [containing] + [r for r in records if r['id'] != containing['id']][:limit - 1]
+    return records
+
+
+def get_nearby_stations(lon, lat, limit):
+    return get_nearby('stations', lon, lat, limit)
+
+
+def get_nearby_minibasins(lon, lat, limit):
+    return get_nearby('minibasins', lon, lat, limit)
@@ -0,0 +1,203 @@
+# encoding: utf-8
+"""
+Aggregated values over a set of minibasins (a region): mean, sum and percentiles of a variable, per date.
+Computed set-based by PostgreSQL, in a single query. The region can be a list of minibasin ids, a polygon, or a named
+region (REGIONS_TABLE). The results of the named regions are cached, per data version.
+"""
+import json
+from numbers import Number
+from os import environ
+
+from sqlalchemy.exc import DBAPIError
+
+from . import database, state
+from .cache import LRUCache
+from .minibasin import MINIBASINS_TABLE
+
+# Named regions table (columns `name` and `wkb_geometry`, EPSG:4326). Might use the schemas placeholders (see
+# database.sql())
+REGIONS_TABLE = environ.get('REGIONS_TABLE', '{geo_schema}.regions')
+REGIONS_CACHE_SIZE = int(environ.get('REGIONS_CACHE_SIZE', 256))
+# Max number of minibasins in a list of minibasin ids
+MAX_REGION_CELLS = 10000
+
+_accepted_datatypes = ['assimilated', 'mgbstandard', 'forecast']
+# Aggregated column, for each variable and dataserie
+_columns = {
+    'flow': {
+        'mgbstandard': 'flow_mean',
+        'assimilated': 'flow_median',
+        'forecast': 'flow_median',
+    },
+    'elevation': {
+        'mgbstandard': 'elevation_mean',
+        'assimilated': 'elevation_median',
+        'forecast': 'elevation_median',
+    },
+}
+variables = list(_columns.keys())
+
+# How the region's minibasins are selected
+_cells_queries = {
+    'cells': "SELECT DISTINCT unnest(CAST(:cells AS integer[])) AS id",
+    'geometry': ("SELECT id FROM " + MINIBASINS_TABLE +
+                 " WHERE ST_Intersects(wkb_geometry, ST_SetSRID(ST_GeomFromGeoJSON(:geometry), 4326))"),
+    'region': ("SELECT m.id FROM " + MINIBASINS_TABLE + " m JOIN " + REGIONS_TABLE +
+               " r ON ST_Intersects(ST_PointOnSurface(m.wkb_geometry), r.wkb_geometry) WHERE r.name = :region"),
+}
+
+_aggregate_query = """
+    WITH cells AS (
+        {cells_query}
+    ),
+    bounds AS (
+        SELECT coalesce(CAST(:start AS timestamp), max(date) - interval '1 year') AS start_date,
+               coalesce(CAST(:end AS timestamp), 'infinity') AS end_date
+        FROM {{schema}}.{table}
+    )
+    SELECT d.date, count(d.{column}) AS count, avg(d.{column}) AS mean, sum(d.{column}) AS sum,
+           min(d.{column}) AS min, max(d.{column}) AS max,
+           percentile_cont(ARRAY[0.1, 0.5, 0.9]) WITHIN GROUP (ORDER BY d.{column}) AS percentiles
+    FROM {{schema}}.{table} d
+    JOIN cells c ON c.id = d.cell_id
+    CROSS JOIN bounds b
+    WHERE d.date >= b.start_date AND d.date <= b.end_date
+    GROUP BY d.date
+    ORDER BY d.date
+"""
+
+_cache = LRUCache('regions', REGIONS_CACHE_SIZE)
+
+
+def _round(value):
+    return round(float(value), 3) if value is not None else None
+
+
+def get_regions():
+    """
+    Retrieve the names of the named regions
+    """
+    with database.connect() as conn:
+        rs = conn.execute(database.sql("SELECT name FROM " + REGIONS_TABLE + " ORDER BY name"))
+        return [row[0] for row in rs.fetchall()]
+
+
+def _validate_ring(ring):
+    if not isinstance(ring, list) or len(ring) < 4:
+        return 'a linear ring must have at least 4 positions'
+    for position in ring:
+        if not (isinstance(position, list) and len(position) in [2, 3]
+                and all(isinstance(c, Number) and not isinstance(c, bool) for c in position)):
+            return 'invalid position {}'.format(json.dumps(position)[:50])
+        if not (-180 <= position[0] <= 180 and -90 <= position[1] <= 90):
+            return 'position out of bounds {}'.format(json.dumps(position)[:50])
+    if ring[0][:2] != ring[-1][:2]:
+        return 'a linear ring must be closed'
+    return None
+
+
+def validate_geometry(geometry):
+    """
+    Check that geometry is a GeoJSON Polygon or MultiPolygon (dict), in WGS84
+    Returns the error message, None if it is valid
+    """
+    if not isinstance(geometry, dict) or geometry.get('type') not in ['Polygon', 'MultiPolygon']:
+        return 'geometry must be a GeoJSON Polygon or MultiPolygon'
+    coordinates = geometry.get('coordinates')
+    polygons = [coordinates] if geometry['type'] == 'Polygon' else coordinates
+    if not isinstance(polygons, list) or not polygons:
+        return 'invalid geometry coordinates'
+    for polygon in polygons:
+        if not isinstance(polygon, list) or not polygon:
+            return 'invalid geometry coordinates'
+        for ring in polygon:
+            error = _validate_ring(ring)
+            if error:
+                return 'invalid geometry: {}'.format(error)
+    return None
+
+
+def _region_exists(conn, region):
+    return conn.execute(database.sql("SELECT 1 FROM " + REGIONS_TABLE + " WHERE name = :region LIMIT 1"),
+                        region=region).fetchone() is not None
+
+
+def aggregate(datatype, variable='flow', cells=None, geometry=None, region=None, start=None, end=None):
+    """
+    Aggregate the values of a set of minibasins, per date.
+    The minibasins are selected by either (in this order of precedence):
+      * cells: list of minibasin ids
+      * geometry: GeoJSON geometry (dict) in WGS84. Selects the minibasins it intersects
+      * region: name of a region of REGIONS_TABLE. Selects the minibasins whose surface point is in the region
+    Params:
+      * datatype: should be one of _accepted_datatypes values
+      * variable: 'flow' or 'elevation'
+      * start, end: date range (datetimes). Default to the last year of data
+    Returns a dict, with the aggregates in the `data` list, or None if the datatype or variable are not supported
+    Raises a KeyError if the region doesn't exist, a ValueError if the geometry is invalid
+    """
+    if datatype not in _accepted_datatypes or variable not in _columns:
+        return None
+    if cells is not None:
+        selection, params = 'cells', {'cells': [int(c) for c in cells]}
+    elif geometry is not None:
+        error = validate_geometry(geometry)
+        if error:
+            raise ValueError(error)
+        selection, params = 'geometry', {'geometry': json.dumps(geometry)}
+    else:
+        selection, params = 'region', {'region': region}
+
+    if selection == 'region':
+        key = (database.current_basin(), region, datatype, variable, start, end,
+               state.get_data_version(['data_{}'.format(datatype)]))
+        result = _cache.get(key)
+        if result is not None:
+            return result
+
+    query = _aggregate_query.format(
+        cells_query=_cells_queries[selection],
+        table='data_{}'.format(datatype),
+        column=_columns[variable][datatype],
+    )
+    with database.connect() as conn:
+        if selection == 'region' and not _region_exists(conn, region):
+            raise KeyError(region)
+        try:
+            rs = conn.execute(database.sql(query), start=start, end=end, **params)
+        except DBAPIError as error:
+            if selection != 'geometry':
+                raise
+            # e.g. a self-intersecting polygon (GEOS topology exception)
+            raise ValueError('invalid geometry: {}'.format(str(error.orig).split('\n')[0]))
+        records = rs.fetchall()
+    data = []
+    for row in records:
+        percentiles = row['percentiles'] or [None, None, None]
+        data.append({
+            'date': row['date'].isoformat(),
+            'count': row['count'],
+            'mean': _round(row['mean']),
+            'sum': _round(row['sum']),
+            'min': _round(row['min']),
+            'max': _round(row['max']),
+            'p10': _round(percentiles[0]),
+            'median': _round(percentiles[1]),
+            'p90': _round(percentiles[2]),
+        })
+    result = {
+        'dataserie': datatype,
+        'variable': variable,
+        'data': data,
+    }
+    if selection == 'region':
+        result['region'] = region
+        _cache.set(key, result)
+    return result
+
+
+def evict(basin, datatype):
+    """
+    Remove the cached results of a basin's dataserie
+    """
+    return _cache.evict(lambda k: k[0] == basin and k[2] == datatype)
@@ -0,0 +1,47 @@
+# encoding: utf-8
+"""
+Sampling profiler, shared by the API (see flask_app/profiling.py) and the publication script (see
+scripts/profiling.py): the stack of a thread is sampled at regular intervals, and the samples are written as collapsed
+stacks (one `frame;frame;frame count` line per distinct stack), that can be turned into a flamegraph with
+flamegraph.pl or loaded in https://www.speedscope.app
+"""
+from collections import Counter
+from os import path
+import sys
+import threading
+
+
+class Sampler(threading.Thread):
+    """
+    Samples the stack of a thread at regular intervals, and counts the distinct stacks
+    """
+    def __init__(self, thread_id, interval):
+        super().__init__(name='hyfaa-profiler', daemon=True)
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopping = threading.Event()
+
+    def run(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append('{} ({}:{})'.format(code.co_name, path.basename(code.co_filename), code.co_firstlineno))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopping.set()
+        self.join()
+
+    def write_collapsed(self, filepath, max_stacks=None):
+        """
+        Write the samples as collapsed stacks. If max_stacks is set, only the max_stacks most frequent stacks are
+        written
+        """
+        with open(filepath, 'w') as f:
+            for stack, count in self.stacks.most_common(max_stacks):
+                f.write('{} {}\n'.format(stack, count))
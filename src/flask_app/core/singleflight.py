@@ -0,0 +1,221 @@
+# encoding: utf-8
+"""
+Request coalescing ("single flight"): concurrent identical lookups share a single execution. The first caller runs
+the lookup, the other ones wait for its result instead of running the same query.
+Right after a publication, the caches are cold and a lot of users request the same popular stations at the same
+time: this prevents the DB from running the same queries dozens of times.
+
+Within a worker, the callers are coalesced in memory. Across the workers of a host (if SINGLEFLIGHT_CROSS_WORKER is
+set, needs STORAGE_PATH), they are coalesced through file locks: the worker holding the lock runs the lookup and writes
+its result in a file, that the waiting workers read. The results must then be JSON-serializable. The waits are
+bounded (SINGLEFLIGHT_WAIT_TIMEOUT, the lookup is then run anyway), and the lock and result files are removed once
+they are older than SINGLEFLIGHT_FILES_TTL.
+"""
+from os import environ, path
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows: no cross-worker coalescing
+    fcntl = None
+
+from . import metrics
+
+STORAGE_PATH = environ.get('STORAGE_PATH')
+SINGLEFLIGHT_CROSS_WORKER = environ.get('SINGLEFLIGHT_CROSS_WORKER', 'false').lower() in ['true', '1', 'yes']
+# Max time (s) a worker waits for another worker's lookup, before running it itself
+SINGLEFLIGHT_WAIT_TIMEOUT = float(environ.get('SINGLEFLIGHT_WAIT_TIMEOUT', 10))
+# Age (s) after which the lock and result files are removed. The results are only useful to the workers that were
+# waiting while they were computed
+SINGLEFLIGHT_FILES_TTL = 60
+# Delay (s) between two attempts to take a busy file lock
+_LOCK_RETRY_INTERVAL = 0.02
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces the concurrent calls sharing the same key
+    """
+    def __init__(self, name, cross_worker=SINGLEFLIGHT_CROSS_WORKER):
+        self.name = name
+        self._calls = dict()
+        self._lock = threading.Lock()
+        self._lock_dir = None
+        if cross_worker:
+            if fcntl is None or not STORAGE_PATH:
+                logging.warning("Cross-worker request coalescing needs fcntl and STORAGE_PATH: disabled")
+            else:
+                self._lock_dir = path.join(STORAGE_PATH, 'singleflight', name)
+        self._swept_at = time.monotonic()
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Run fn(*args, **kwargs), unless a call with the same key is already running, in which case its result is
+        returned (or its exception raised) instead
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+        if not leader:
+            call.done.wait()
+            metrics.record_coalesced(self.name, 'worker')
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            if self._lock_dir:
+                call.result = self._do_cross_worker(key, fn, *args, **kwargs)
+            else:
+                call.result = fn(*args, **kwargs)
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+    def _do_cross_worker(self, key, fn, *args, **kwargs):
+        """
+        Run the call while holding the key's file lock. A worker that had to wait for the lock uses the result written
+        by the worker that held it, if it was written after it started waiting. If the lock can't be taken within
+        SINGLEFLIGHT_WAIT_TIMEOUT, the call is run without it
+        """
+        try:
+            os.makedirs(self._lock_dir, exist_ok=True)
+        except OSError as error:
+            logging.warning("Could not create the request coalescing folder: {}".format(error))
+            return fn(*args, **kwargs)
+        self._sweep()
+        basename = path.join(self._lock_dir, hashlib.md5(repr(key).encode('utf-8')).hexdigest())
+        started_at = time.time()
+        lock_file = self._acquire(basename + '.lock', started_at + SINGLEFLIGHT_WAIT_TIMEOUT)
+        if lock_file is None:
+            logging.warning("Timed out waiting for a coalesced request ({}), running it".format(self.name))
+            return fn(*args, **kwargs)
+        with lock_file:
+            try:
+                result = self._read_result(basename + '.json', started_at)
+                if result is not None:
+                    metrics.record_coalesced(self.name, 'host')
+                    return result['value']
+                value = fn(*args, **kwargs)
+                self._write_result(basename + '.json', value)
+                return value
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @classmethod
+    def _acquire(cls, lock_path, deadline):
+        """
+        Open and lock the lock file, retrying until the deadline (time.time()). Returns the locked file, or None if
+        the lock couldn't be taken in time.
+        The lock file might be removed by _sweep() while this worker waits on it: the lock is then taken on the
+        removed file, and taken again on the current one. Its mtime is updated once locked, so that it isn't swept
+        while in use
+        """
+        while True:
+            lock_file = open(lock_path, 'a')
+            try:
+                if not cls._flock(lock_file, deadline):
+                    lock_file.close()
+                    return None
+                try:
+                    current = os.stat(lock_path).st_ino == os.fstat(lock_file.fileno()).st_ino
+                    if current:
+                        os.utime(lock_path)
+                except FileNotFoundError:
+                    current = False
+            except BaseException:
+                lock_file.close()
+                raise
+            if current:
+                return lock_file
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+            lock_file.close()
+
+    @staticmethod
+    def _flock(lock_file, deadline):
+        """
+        Take the file lock, retrying until the deadline (time.time()). Returns whether it was taken
+        """
+        while True:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                if time.time() >= deadline:
+                    return False
+                time.sleep(_LOCK_RETRY_INTERVAL)
+
+    def _sweep(self):
+        """
+        Remove the lock and result files older than SINGLEFLIGHT_FILES_TTL (at most every SINGLEFLIGHT_FILES_TTL
+        seconds). The lock files that are held are left alone. A worker already waiting on a removed lock file takes
+        the lock again on the new one, see _acquire()
+        """
+        now = time.monotonic()
+        if now - self._swept_at < SINGLEFLIGHT_FILES_TTL:
+            return
+        self._swept_at = now
+        expired_before = time.time() - SINGLEFLIGHT_FILES_TTL
+        try:
+            filenames = os.listdir(self._lock_dir)
+        except OSError:
+            return
+        for filename in filenames:
+            filepath = path.join(self._lock_dir, filename)
+            try:
+                if os.stat(filepath).st_mtime >= expired_before:
+                    continue
+                if filename.endswith('.lock'):
+                    result_path = filepath[:-len('.lock')] + '.json'
+                    if path.exists(result_path) and os.stat(result_path).st_mtime >= expired_before:
+                        continue
+                    with open(filepath, 'a') as lock_file:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        os.remove(filepath)
+                else:
+                    os.remove(filepath)
+            except (OSError, BlockingIOError):
+                # removed by another worker, or lock held
+                continue
+
+    @staticmethod
+    def _read_result(result_path, written_after):
+        try:
+            if os.stat(result_path).st_mtime < written_after:
+                return None
+            with open(result_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    @staticmethod
+    def _write_result(result_path, value):
+        try:
+            fd, tmp_path = tempfile.mkstemp(dir=path.dirname(result_path), suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'value': value}, f)
+            os.replace(tmp_path, result_path)
+        except (OSError, TypeError, ValueError) as error:
+            logging.warning("Could not write the coalesced request result: {}".format(error))
@@ -0,0 +1,73 @@
+# encoding: utf-8
+"""
+Publication state of each basin, read from its hyfaa.state table (updated by the publication script after each run).
+Provides the data version, used to key the caches: it changes on every publication
+"""
+from os import environ
+import hashlib
+import threading
+import time
+
+from . import database
+
+# Delay (s) during which the state is not read again from the DB
+DATA_VERSION_TTL = int(environ.get('DATA_VERSION_TTL', 60))
+
+# Per basin (None for the default DB): (state, read_at)
+_states = dict()
+_state_lock = threading.Lock()
+
+
+def _read_state(read_only=True):
+    with database.connect(read_only=read_only) as conn:
+        rs = conn.execute(database.sql(
+            "SELECT tablename, last_updated_jd, last_updated_without_errors_jd, update_errors FROM {schema}.state"))
+        return {row[0]: tuple(row[1:]) for row in rs.fetchall()}
+
+
+def get_state():
+    """
+    Get the publication state of the current basin, as a dict
+    {tablename: (last_updated_jd, last_updated_without_errors_jd, update_errors)}
+    Read from the DB at most every DATA_VERSION_TTL seconds
+    """
+    basin = database.current_basin()
+    with _state_lock:
+        st, read_at = _states.get(basin, (None, None))
+        if st is None or time.monotonic() - read_at >= DATA_VERSION_TTL:
+            st = _read_state()
+            _states[basin] = (st, time.monotonic())
+        return st
+
+
+def invalidate(basin=None):
+    """
+    Force the state of the given basin (all the basins if None) to be read again from the DB on next access
+    """
+    with _state_lock:
+        if basin is None:
+            _states.clear()
+        else:
+            _states.pop(basin, None)
+
+
+def refresh():
+    """
+    Read the state of the current basin again, from the primary DB: right after a publication, the read replicas
+    might not have caught up yet, and would give the previous version
+    """
+    st = _read_state(read_only=False)
+    with _state_lock:
+        _states[database.current_basin()] = (st, time.monotonic())
+    return st
+
+
+def get_data_version(tablenames=None):
+    """
+    Get the data version, a short string that changes every time the given tables (all the tables if None) are
+    published
+    """
+    st = get_state()
+    keys = sorted(tablenames if tablenames is not None else st.keys())
+    fingerprint = ';'.join(['{}={}'.format(k, st.get(k)) for k in keys])
+    return hashlib.md5(fingerprint.encode('utf-8')).hexdigest()[:12]
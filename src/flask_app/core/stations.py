@@ -2,19 +2,61 @@
 """
 Functions related to stations
 """
-from sqlalchemy import text
+from collections import Counter
+import threading
 
-from .database import engine
+from . import database
 from .minibasin import get_data as get_minibasin_data
 
+_geojson_query = """SELECT jsonb_build_object(
+      'type',     'FeatureCollection',
+      'features', jsonb_agg(feature)
+    )
+    FROM (
+      SELECT jsonb_build_object(
+        'type',       'Feature',
+        'id',         id,
+        'geometry',   ST_AsGeoJSON(wkb_geometry)::jsonb,
+        'properties', to_jsonb(inputs) - 'id' - 'wkb_geometry'
+      ) AS feature
+      FROM (
+        SELECT * FROM {geo_schema}.stations_geo
+      ) inputs
+    ) features;
+    """
+
+_station_statement = database.declare_statement(
+    'get_station', "SELECT * FROM {geo_schema}.stations WHERE id = :id", ['id'])
+
+# Number of data requests per (basin, station), to pre-warm the caches with the most requested stations (see events.py)
+_requests_count = Counter()
+_requests_count_lock = threading.Lock()
+
+
+def record_request(id):
+    """
+    Count a data request of a station, from the API (see get_most_requested())
+    """
+    with _requests_count_lock:
+        _requests_count[(database.current_basin(), id)] += 1
+
+
+def get_most_requested(basin, n):
+    """
+    Get the ids of the n stations of the basin whose data was the most requested (by this worker)
+    """
+    with _requests_count_lock:
+        return [k[1] for k, c in _requests_count.most_common() if k[0] == basin][:n]
+
+
 def get_stations():
     """
     Retrieve stations records from geospatial.stations table
     Returns a list of dicts
     """
     stations=[]
-    with engine.connect() as conn:
-        query = text("SELECT * FROM geospatial.stations")
+    with database.connect() as conn:
+        query = database.sql("SELECT * FROM {geo_schema}.stations")
         rs = conn.execute(query)
         records = rs.fetchall()
         for row in records:
@@ -33,24 +75,8 @@ def get_stations_as_geojson():
     Returns geojson feature collection
     """
     stations=[]
-    with engine.connect() as conn:
-        sql_query = """SELECT jsonb_build_object(
-              'type',     'FeatureCollection',
-              'features', jsonb_agg(feature)
-            )
-            FROM (
-              SELECT jsonb_build_object(
-                'type',       'Feature',
-                'id',         id,
-                'geometry',   ST_AsGeoJSON(wkb_geometry)::jsonb,
-                'properties', to_jsonb(inputs) - 'id' - 'wkb_geometry'
-              ) AS feature
-              FROM (
-                SELECT * FROM geospatial.stations_geo
-              ) inputs
-            ) features;
-            """
-        query = text(sql_query)
+    with database.connect() as conn:
+        query = database.sql(_geojson_query)
         rs = conn.execute(query)
         record = rs.fetchone()
         return record[0]
@@ -64,8 +90,8 @@ def get_station(id):
         * id: id of the station (*not the minibasin id*)
     Returns a dict
     """
-    with engine.connect() as conn:
-        query = text("SELECT * FROM geospatial.stations WHERE id = :id")
+    with database.connect() as conn:
+        query = database.statement(_station_statement)
         rs = conn.execute(query, id=id)
         record = rs.fetchone()
         if record:
@@ -86,9 +112,11 @@ def get_data(id, datatype, opts):
       * datatype: should be one of _accepted_datatypes values
       * opts: filtering options
         * duration: Time lapse to retrieve. Should be consistent with the textual representation of a PostgreSQL date/time interval (https://www.postgresql.org/docs/9.1/datatype-datetime.html). Default is '1 year'
+        * since: only retrieve the rows updated since this time (datetime, or dict {dataserie: datetime}). The
+          `since` and `high_water_marks` fields are then added, see minibasin.get_changes()
     """
-    with engine.connect() as conn:
-        query = text("SELECT * FROM geospatial.stations WHERE id = :id")
+    with database.connect() as conn:
+        query = database.statement(_station_statement)
         rs = conn.execute(query, id=id)
         record = rs.fetchone()
         if record:
@@ -99,6 +127,8 @@ def get_data(id, datatype, opts):
             }
             minibasin_data = get_minibasin_data(st['minibasin'], datatype, opts)
             st['data'] = minibasin_data['data']
+            if 'high_water_marks' in minibasin_data:
+                st['since'] = minibasin_data['since']
+                st['high_water_marks'] = minibasin_data['high_water_marks']
             return st
     return None
-
@@ -0,0 +1,243 @@
+# encoding: utf-8
+"""
+Mapbox vector tiles (MVT) of the minibasins, with the latest published values of a dataserie as attributes.
+Tiles are generated by PostGIS (needs PostGIS >= 3.0), then cached in memory (LRU, per worker) and on disk (shared
+by the workers, if STORAGE_PATH is set). Both are keyed by the data version (see state.py), so a publication
+invalidates them. The versions of the disk cache no longer in use are purged as the tiles of the current version are
+read and written (see _mark_used()).
+"""
+from os import environ, path
+import logging
+import math
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from . import database, state
+from .cache import LRUCache
+from .minibasin import MINIBASINS_TABLE
+
+STORAGE_PATH = environ.get('STORAGE_PATH')
+TILES_DATASERIE = environ.get('TILES_DATASERIE', 'assimilated')
+TILES_MEMORY_CACHE_SIZE = int(environ.get('TILES_MEMORY_CACHE_SIZE', 2048))
+TILES_MAX_ZOOM = 16
+TILES_LAYER_NAME = 'minibasins'
+# Seed the tiles up to this zoom level after each publication (needs EVENTS_ENABLED, see events.py). 0 to disable
+TILES_SEED_ON_PUBLISH = int(environ.get('TILES_SEED_ON_PUBLISH', 0))
+
+# Attributes of the tiles features, for each dataserie: {attribute: column}
+_attributes = {
+    'mgbstandard': {
+        'flow': 'flow_mean',
+        'elevation': 'elevation_mean',
+    },
+    'assimilated': {
+        'flow': 'flow_median',
+        'flow_mad': 'flow_mad',
+        'elevation': 'elevation_median',
+    },
+    'forecast': {
+        'flow': 'flow_median',
+        'flow_mad': 'flow_mad',
+        'elevation': 'elevation_median',
+    },
+}
+
+_tile_query = """
+    WITH bounds AS (
+        SELECT ST_TileEnvelope(:z, :x, :y) AS geom
+    ),
+    latest AS (
+        SELECT max(date) AS date FROM {{schema}}.{table}
+    ),
+    mvtgeom AS (
+        SELECT ST_AsMVTGeom(ST_Transform(m.wkb_geometry, 3857), bounds.geom) AS geom,
+               m.id, to_char(latest.date, 'YYYY-MM-DD') AS date, {attributes}
+        FROM {minibasins} m
+        CROSS JOIN bounds
+        CROSS JOIN latest
+        LEFT JOIN {{schema}}.{table} d ON d.cell_id = m.id AND d.date = latest.date
+        WHERE ST_Intersects(m.wkb_geometry, ST_Transform(bounds.geom, 4326))
+    )
+    SELECT ST_AsMVT(mvtgeom.*, '{layer}') FROM mvtgeom
+"""
+
+_memory_cache = LRUCache('tiles', TILES_MEMORY_CACHE_SIZE)
+# Marker file of the disk cache versions, touched while the version is in use
+_VERSION_MARKER = '.last_used'
+# Disk cache versions marked as used by this worker: {(root, version): time of the last touch}
+_marked = dict()
+_marked_lock = threading.Lock()
+
+
+def _tablename(dataserie):
+    return 'data_{}'.format(dataserie)
+
+
+def _query(dataserie):
+    return database.sql(_tile_query.format(
+        table=_tablename(dataserie),
+        minibasins=MINIBASINS_TABLE,
+        layer=TILES_LAYER_NAME,
+        attributes=', '.join(['d.{} AS {}'.format(col, attr) for attr, col in _attributes[dataserie].items()]),
+    ))
+
+
+def is_valid_tile(z, x, y):
+    return 0 <= z <= TILES_MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z
+
+
+def _disk_cache_root(dataserie):
+    if not STORAGE_PATH:
+        return None
+    basin = database.current_basin()
+    return path.join(STORAGE_PATH, 'tiles', basin, dataserie) if basin else path.join(STORAGE_PATH, 'tiles', dataserie)
+
+
+def _disk_cache_path(dataserie, version, z, x, y):
+    root = _disk_cache_root(dataserie)
+    return path.join(root, version, str(z), str(x), '{}.mvt'.format(y)) if root else None
+
+
+def _read_disk_cache(tile_path):
+    try:
+        with open(tile_path, 'rb') as f:
+            return f.read()
+    except (OSError, TypeError):
+        return None
+
+
+def _write_disk_cache(dataserie, version, tile_path, tile):
+    """
+    Write the tile on disk (atomically, since several workers might write it concurrently)
+    """
+    try:
+        os.makedirs(path.dirname(tile_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=path.dirname(tile_path), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(tile)
+        os.replace(tmp_path, tile_path)
+    except OSError as error:
+        logging.warning("Could not write tile in disk cache: {}".format(error))
+
+
+def _version_last_used(version_dir):
+    try:
+        return path.getmtime(path.join(version_dir, _VERSION_MARKER))
+    except OSError:
+        # older version, without marker
+        return path.getmtime(version_dir)
+
+
+def _purge_disk_cache(dataserie, keep):
+    """
+    Remove the versions of the disk cache other than `keep` (the current one) and the previous one (the latest used),
+    that were not used during the last DATA_VERSION_TTL seconds: the workers might still be using the previous
+    version for that long after a publication
+    """
+    root = _disk_cache_root(dataserie)
+    if not root or not path.isdir(root):
+        return
+    versions = []
+    for version in os.listdir(root):
+        if version == keep:
+            continue
+        try:
+            versions.append((_version_last_used(path.join(root, version)), version))
+        except OSError:
+            continue
+    versions.sort(reverse=True)
+    for last_used, version in versions[1:]:
+        if time.time() - last_used >= state.DATA_VERSION_TTL:
+            shutil.rmtree(path.join(root, version), ignore_errors=True)
+
+
+def _mark_used(dataserie, version):
+    """
+    Touch the marker file of a disk cache version, and purge the versions no longer in use. Done at most every
+    DATA_VERSION_TTL / 2 seconds per version and worker
+    """
+    root = _disk_cache_root(dataserie)
+    if not root:
+        return
+    now = time.monotonic()
+    with _marked_lock:
+        if now - _marked.get((root, version), -state.DATA_VERSION_TTL) < state.DATA_VERSION_TTL / 2:
+            return
+        _marked[(root, version)] = now
+    try:
+        os.makedirs(path.join(root, version), exist_ok=True)
+        marker = path.join(root, version, _VERSION_MARKER)
+        with open(marker, 'a'):
+            os.utime(marker)
+    except OSError as error:
+        logging.warning("Could not mark the tiles disk cache version {} as used: {}".format(version, error))
+        return
+    _purge_disk_cache(dataserie, keep=version)
+
+
+def get_tile(z, x, y, dataserie=TILES_DATASERIE):
+    """
+    Get a minibasins vector tile, with the latest values of the dataserie as attributes.
+    Returns a (tile, version) tuple. tile is the MVT-encoded tile (bytes, might be empty), version the data version
+    it was generated from
+    """
+    version = state.get_data_version([_tablename(dataserie)])
+    key = (database.current_basin(), dataserie, version, z, x, y)
+    tile = _memory_cache.get(key)
+    if tile is not None:
+        return tile, version
+
+    tile_path = _disk_cache_path(dataserie, version, z, x, y)
+    _mark_used(dataserie, version)
+    tile = _read_disk_cache(tile_path)
+    if tile is None:
+        with database.connect() as conn:
+            record = conn.execute(_query(dataserie), z=z, x=x, y=y).fetchone()
+            tile = bytes(record[0]) if record and record[0] is not None else b''
+        if tile_path:
+            _write_disk_cache(dataserie, version, tile_path, tile)
+    _memory_cache.set(key, tile)
+    return tile, version
+
+
+def evict(basin, dataserie):
+    """
+    Remove the tiles of a basin's dataserie from the memory cache (the disk cache is purged as the next version is
+    used)
+    """
+    return _memory_cache.evict(lambda k: k[0] == basin and k[1] == dataserie)
+
+
+def _lonlat_to_tile(lon, lat, z):
+    lat = max(min(lat, 85.0511), -85.0511)
+    n = 2 ** z
+    x = int((lon + 180.) / 360. * n)
+    y = int((1. - math.asinh(math.tan(math.radians(lat))) / math.pi) / 2. * n)
+    return min(max(x, 0), n - 1), min(max(y, 0), n - 1)
+
+
+def seed(max_zoom, dataserie=TILES_DATASERIE):
+    """
+    Generate the tiles covering the minibasins extent, from zoom 0 to max_zoom, so they are cached right after a
+    publication. Returns the number of generated tiles
+    """
+    with database.connect() as conn:
+        extent = conn.execute(database.sql(
+            "SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) FROM (SELECT ST_Extent(wkb_geometry) AS e FROM {}) t"
+            .format(MINIBASINS_TABLE))).fetchone()
+    if not extent or extent[0] is None:
+        return 0
+    xmin, ymin, xmax, ymax = extent
+    nb = 0
+    for z in range(0, min(max_zoom, TILES_MAX_ZOOM) + 1):
+        x0, y0 = _lonlat_to_tile(xmin, ymax, z)
+        x1, y1 = _lonlat_to_tile(xmax, ymin, z)
+        for x in range(x0, x1 + 1):
+            for y in range(y0, y1 + 1):
+                get_tile(z, x, y, dataserie)
+                nb += 1
+        logging.info("Seeded tiles for zoom level {}".format(z))
+    return nb
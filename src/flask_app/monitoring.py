@@ -0,0 +1,60 @@
+"""
+Request-level instrumentation of the Flask app: per-endpoint latency and response size metrics, exposed on /metrics
+(Prometheus format), and an optional slow-requests log.
+Enabled by the METRICS_ENABLED and SLOW_REQUEST_THRESHOLD_MS configuration variables
+"""
+import logging
+import time
+
+from flask import Response, g, request
+
+from .core import database, metrics
+
+
+def _endpoint_label():
+    # Use the URL rule, not the actual path, to keep a bounded number of labels
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+
+def init_app(app):
+    """
+    Register the instrumentation hooks and the /metrics route.
+    Needs to be called before the DB engine is created (database.init_app)
+    """
+    metrics_enabled = str(app.config.get('METRICS_ENABLED', False)).lower() in ['true', '1', 'yes']
+    slow_request_threshold = float(app.config.get('SLOW_REQUEST_THRESHOLD_MS') or 0) / 1000.
+
+    if metrics_enabled and metrics.init_metrics():
+        database.add_engine_hook(metrics.instrument_engine)
+        database.add_checkout_observer(metrics.observe_checkout)
+
+        @app.route('/metrics')
+        def prometheus_metrics():
+            data, content_type = metrics.generate_latest()
+            return Response(data, content_type=content_type)
+    else:
+        metrics_enabled = False
+
+    if not metrics_enabled and not slow_request_threshold:
+        return
+
+    @app.before_request
+    def start_timer():
+        g.request_start_time = time.perf_counter()
+
+    @app.after_request
+    def record_request(response):
+        start_time = g.pop('request_start_time', None)
+        if start_time is None:
+            return response
+        elapsed = time.perf_counter() - start_time
+        endpoint = _endpoint_label()
+        if metrics_enabled:
+            metrics.REQUEST_LATENCY.labels(request.method, endpoint, response.status_code).observe(elapsed)
+            if response.content_length is not None:
+                metrics.RESPONSE_SIZE.labels(endpoint).observe(response.content_length)
+        if slow_request_threshold and elapsed > slow_request_threshold:
+            logging.warning("Slow request ({:.0f} ms): {} {} {} params={} args={}".format(
+                elapsed * 1000, request.method, request.path, response.status_code,
+                request.view_args, request.args.to_dict()))
+        return response
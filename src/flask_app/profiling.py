@@ -0,0 +1,129 @@
+"""
+On-demand profiling of single requests: when PROFILING_ENABLED is set, a request sent with the `X-Hyfaa-Profile`
+header set to PROFILING_TOKEN is profiled:
+  * the time spent in SQL queries and the total time are returned in a `Server-Timing` header (shown in the browsers
+    dev tools)
+  * the request thread's stack is sampled, and the samples are written as collapsed stacks (for flamegraph.pl or
+    https://www.speedscope.app) in PROFILING_PATH. The file name is returned in the `X-Profile-File` header. Only the
+    PROFILING_MAX_FILES latest profiles are kept
+The other requests are not affected (a thread-local check per SQL query). A single request at a time is profiled per
+worker
+"""
+from hmac import compare_digest
+from os import environ, path
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from flask import g, request
+from sqlalchemy import event
+
+from .core import database
+from .core.sampling import Sampler
+
+PROFILE_HEADER = 'X-Hyfaa-Profile'
+PROFILE_INTERVAL = 0.001
+# Max number of distinct stacks written per profile (the most frequent ones), to bound the files size
+PROFILE_MAX_STACKS = 2000
+
+# Profiled request of the current thread
+_local = threading.local()
+# Held by the profiled request
+_profiling = threading.Lock()
+
+
+def time_sql(engine, name):
+    """
+    Accumulate the SQL queries time of the profiled requests
+    """
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if getattr(_local, 'sql_time', None) is not None:
+            conn.info.setdefault('profile_start_time', []).append(time.perf_counter())
+
+    @event.listens_for(engine, 'after_cursor_execute')
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        start_times = conn.info.get('profile_start_time')
+        if getattr(_local, 'sql_time', None) is not None and start_times:
+            _local.sql_time += time.perf_counter() - start_times.pop(-1)
+            _local.sql_count += 1
+
+
+def _purge(profiling_path, max_files):
+    """
+    Remove the oldest profiles, keeping the max_files latest ones
+    """
+    try:
+        filepaths = [path.join(profiling_path, f) for f in os.listdir(profiling_path) if f.endswith('.collapsed')]
+        filepaths.sort(key=path.getmtime, reverse=True)
+        for filepath in filepaths[max_files:]:
+            os.remove(filepath)
+    except OSError as error:
+        logging.warning("Could not purge the requests profiles in {}: {}".format(profiling_path, error))
+
+
+def init_app(app):
+    """
+    Register the profiling hooks, if PROFILING_ENABLED (and PROFILING_TOKEN is set).
+    Needs to be called before the DB engine is created (database.init_app)
+    """
+    if str(app.config.get('PROFILING_ENABLED', False)).lower() not in ['true', '1', 'yes']:
+        return
+    token = app.config.get('PROFILING_TOKEN')
+    if not token:
+        logging.warning("Profiling disabled: PROFILING_TOKEN is not set")
+        return
+    storage_path = app.config.get('STORAGE_PATH') or environ.get('STORAGE_PATH')
+    profiling_path = app.config.get('PROFILING_PATH') or (path.join(storage_path, 'profiles') if storage_path
+                                                          else path.join(tempfile.gettempdir(), 'hyfaa-profiles'))
+    max_files = int(app.config.get('PROFILING_MAX_FILES', 100))
+    database.add_engine_hook(time_sql)
+
+    @app.before_request
+    def start_profile():
+        value = request.headers.get(PROFILE_HEADER)
+        if not value or not compare_digest(value.encode(), str(token).encode()):
+            return
+        if not _profiling.acquire(blocking=False):
+            # another request is being profiled
+            return
+        _local.sql_time = 0.
+        _local.sql_count = 0
+        g.profile_sampler = Sampler(threading.get_ident(), PROFILE_INTERVAL)
+        g.profile_start_time = time.perf_counter()
+        g.profile_sampler.start()
+
+    def stop_profile():
+        sampler = g.pop('profile_sampler', None)
+        if sampler is not None:
+            sampler.stop()
+            _local.sql_time = None
+            _profiling.release()
+        return sampler
+
+    @app.after_request
+    def end_profile(response):
+        sql_time, sql_count = getattr(_local, 'sql_time', None), getattr(_local, 'sql_count', 0)
+        sampler = stop_profile()
+        if sampler is None:
+            return response
+        total = time.perf_counter() - g.pop('profile_start_time')
+        response.headers['Server-Timing'] = 'sql;desc="{} queries";dur={:.1f}, total;dur={:.1f}'.format(
+            sql_count, sql_time * 1000, total * 1000)
+        try:
+            os.makedirs(profiling_path, exist_ok=True)
+            filename = '{}-{}-{}.collapsed'.format(request.endpoint or 'unmatched',
+                                                  time.strftime('%Y%m%d-%H%M%S'), threading.get_ident())
+            sampler.write_collapsed(path.join(profiling_path, filename), PROFILE_MAX_STACKS)
+            response.headers['X-Profile-File'] = filename
+        except OSError as error:
+            logging.warning("Could not write the request profile in {}: {}".format(profiling_path, error))
+        _purge(profiling_path, max_files)
+        return response
+
+    @app.teardown_request
+    def reset_profile(exc):
+        # if the request failed before after_request
+        stop_profile()
@@ -0,0 +1,83 @@
+"""
+Profiling of the publication script (see hyfaa_netcdf2DB.py --profile):
+  * per-phase timers: time spent in each phase (netCDF read, array transform, tuples encoding, SQL execution...),
+    summarized in the logs at the end of the run
+  * a sampling profiler: the main thread's stack is sampled every PROFILE_INTERVAL seconds, and the samples are
+    written as collapsed stacks (one `frame;frame;frame count` line per distinct stack), that can be turned into a
+    flamegraph with flamegraph.pl or loaded in https://www.speedscope.app
+Disabled by default: phase() is then a no-op
+The Sampler is shared with the API, that uses it to profile single requests (see flask_app/core/sampling.py)
+"""
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from os import path
+import logging
+import os
+import sys
+import threading
+import time
+
+# the script is run from the scripts folder: make the flask_app package (src folder) importable
+sys.path.append(path.dirname(path.dirname(path.abspath(__file__))))
+from flask_app.core.sampling import Sampler
+
+PROFILE_INTERVAL = 0.005
+
+_enabled = False
+_phases = defaultdict(float)
+_phases_count = Counter()
+_sampler = None
+_output_dir = None
+_started_at = None
+
+
+@contextmanager
+def phase(name):
+    """
+    Time a phase of the publication. Usage: `with profiling.phase('sql_execution'):`
+    """
+    if not _enabled:
+        yield
+        return
+    tic = time.perf_counter()
+    try:
+        yield
+    finally:
+        _phases[name] += time.perf_counter() - tic
+        _phases_count[name] += 1
+
+
+def start(output_dir):
+    """
+    Start profiling the current (main) thread. The collapsed stacks are written in output_dir on stop()
+    """
+    global _enabled, _sampler, _output_dir, _started_at
+    _phases.clear()
+    _phases_count.clear()
+    _output_dir = output_dir
+    _started_at = time.perf_counter()
+    _sampler = Sampler(threading.get_ident(), PROFILE_INTERVAL)
+    _sampler.start()
+    _enabled = True
+
+
+def stop(label='publisher'):
+    """
+    Stop profiling, log the phases summary and write the collapsed stacks. Returns the collapsed stacks file path
+    """
+    global _enabled
+    if not _enabled:
+        return None
+    _enabled = False
+    _sampler.stop()
+    total = time.perf_counter() - _started_at
+    lines = ["Profile summary ({:.1f}s in total):".format(total)]
+    for name, elapsed in sorted(_phases.items(), key=lambda p: p[1], reverse=True):
+        lines.append("  {:<20} {:>9.2f}s {:>6.1f}%  ({} calls)".format(name, elapsed, 100. * elapsed / total,
+                                                                     _phases_count[name]))
+    logging.info('\n'.join(lines))
+    os.makedirs(_output_dir, exist_ok=True)
+    filepath = path.join(_output_dir, '{}-{}-{}.collapsed'.format(label, time.strftime('%Y%m%d-%H%M%S'), os.getpid()))
+    _sampler.write_collapsed(filepath)
+    logging.info("Collapsed stacks written in {} ({} samples)".format(filepath, sum(_sampler.stacks.values())))
+    return filepath
@@ -0,0 +1,220 @@
+"""
+Retention policies for the data tables. Applied by the publication script after the publication (see
+hyfaa_netcdf2DB.py --retention), and configured per dataserie with the `retention` entry of the source definition
+(see script_config.hjson):
+  * keep_runs: only keep the rows published by the N latest runs (distinct update_time values). Meant for the
+    forecasts: the horizons of the previous runs are never updated again, and pile up otherwise
+  * rollup_older_than: roll up the daily rows older than this (PostgreSQL interval, e.g. '5 years') into monthly
+    means, in the {table}_monthly table, then remove them from the daily table
+  * batch_days: size (days) of the date ranges deleted in a single transaction (default RETENTION_BATCH_DAYS)
+
+The rows are deleted by date ranges, one transaction per range, so that the locks and the WAL stay small. If the
+table is partitioned by date, the partitions that are entirely out of the retention window are dropped instead.
+"""
+from datetime import datetime, timedelta
+import logging
+import re
+import time
+
+RETENTION_BATCH_DAYS = 31
+
+_partition_upper_bound = re.compile(r"TO \('([^']+)'\)")
+
+
+def apply_retention(conn, schema, ds):
+    """
+    Apply the retention policy of a dataserie
+    Params:
+      * conn: psycopg2 connection
+      * schema: DB schema of the data tables
+      * ds: dataserie definition (one element of script_config['sources'] list), with a `retention` entry
+    Returns the number of removed rows (dropped partitions not included)
+    """
+    policy = ds.get('retention')
+    if not policy:
+        return 0
+    tic = time.perf_counter()
+    table = ds['tablename']
+    batch_days = int(policy.get('batch_days', RETENTION_BATCH_DAYS))
+    nb = 0
+    if policy.get('keep_runs'):
+        nb += _drop_superseded_runs(conn, schema, table, int(policy['keep_runs']), batch_days)
+    if policy.get('rollup_older_than'):
+        nb += _rollup(conn, schema, table, policy['rollup_older_than'], batch_days)
+    logging.info("Retention on {}.{}: removed {} rows in {:.1f}s".format(schema, table, nb, time.perf_counter() - tic))
+    return nb
+
+
+def _oldest_kept_run(conn, schema, table, keep_runs):
+    """
+    The update_time of the oldest of the keep_runs latest runs (None if the table is empty)
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT min(update_time) FROM (
+                SELECT DISTINCT update_time FROM {schema}.{table} WHERE update_time IS NOT NULL
+                ORDER BY update_time DESC LIMIT %s
+            ) runs
+        """.format(schema=schema, table=table), (keep_runs,))
+        return cursor.fetchone()[0]
+
+
+def _rollup_cutoff(conn, older_than):
+    """
+    The date before which the daily rows are rolled up (whole months only)
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT date_trunc('month', now() - %s::interval)::timestamp", (older_than,))
+        return cursor.fetchone()[0]
+
+
+def retention_filter(conn, schema, ds):
+    """
+    Get a function telling whether the retention policy of a dataserie keeps a daily row, given its date and
+    update_time (datetimes). Used by the verify mode (see hyfaa_netcdf2DB.py --verify), so that the days removed by
+    the retention are neither reported as missing nor republished. Returns None if the dataserie has no policy
+    """
+    policy = ds.get('retention')
+    if not policy:
+        return None
+    oldest_kept_run, cutoff = None, None
+    if policy.get('keep_runs'):
+        oldest_kept_run = _oldest_kept_run(conn, schema, ds['tablename'], int(policy['keep_runs']))
+    if policy.get('rollup_older_than'):
+        cutoff = _rollup_cutoff(conn, policy['rollup_older_than'])
+    return lambda date, update_time: (oldest_kept_run is None or update_time >= oldest_kept_run) \
+        and (cutoff is None or date >= cutoff)
+
+
+def _drop_superseded_runs(conn, schema, table, keep_runs, batch_days):
+    """
+    Remove the rows whose update_time is older than the keep_runs latest runs
+    """
+    oldest_kept_run = _oldest_kept_run(conn, schema, table, keep_runs)
+    if oldest_kept_run is None:
+        return 0
+    return _delete_by_date_ranges(conn, schema, table, batch_days,
+                                  condition="update_time < %(oldest_kept_run)s",
+                                  params={'oldest_kept_run': oldest_kept_run})
+
+
+def _rollup(conn, schema, table, older_than, batch_days):
+    """
+    Aggregate the daily rows older than `older_than` into monthly means (whole months only), then remove them
+    Re-running it is harmless: the monthly rows are upserted
+    """
+    cutoff = _rollup_cutoff(conn, older_than)
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT min(date) FROM {schema}.{table} WHERE date < %s".format(schema=schema, table=table),
+                       (cutoff,))
+        first_date = cursor.fetchone()[0]
+    if first_date is None:
+        return 0
+
+    columns = _ensure_rollup_table(conn, schema, table)
+    aggregates = ', '.join(['avg({c}) AS {c}'.format(c=c) for c in columns])
+    updates = ', '.join(['{c}=EXCLUDED.{c}'.format(c=c) for c in ['nb_days', 'update_time'] + columns])
+    query = """
+        INSERT INTO {schema}.{table}_monthly (cell_id, date, nb_days, update_time, {columns})
+        SELECT cell_id, date_trunc('month', date), count(*), max(update_time), {aggregates}
+        FROM {schema}.{table}
+        WHERE date >= %s AND date < %s
+        GROUP BY 1, 2
+        ON CONFLICT ON CONSTRAINT {table}_monthly_pk DO UPDATE SET {updates}
+    """.format(schema=schema, table=table, columns=', '.join(columns), aggregates=aggregates, updates=updates)
+    month = datetime(first_date.year, first_date.month, 1)
+    with conn.cursor() as cursor:
+        while month < cutoff:
+            next_month = (month + timedelta(days=32)).replace(day=1)
+            cursor.execute(query, (month, next_month))
+            conn.commit()
+            month = next_month
+    logging.info("Rolled up {}.{} rows older than {} into {}_monthly".format(schema, table, cutoff, table))
+    return _delete_by_date_ranges(conn, schema, table, batch_days, before=cutoff)
+
+
+def _ensure_rollup_table(conn, schema, table):
+    """
+    Create the {table}_monthly table, if it doesn't exist yet. Returns the names of the aggregated columns (the
+    numeric columns of the daily table)
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT column_name FROM information_schema.columns
+            WHERE table_schema = %s AND table_name = %s
+              AND data_type IN ('double precision', 'real', 'numeric') AND column_name <> 'cell_id'
+            ORDER BY ordinal_position
+        """, (schema, table))
+        columns = [r[0] for r in cursor.fetchall()]
+        cursor.execute("SELECT to_regclass(%s)", ('{}.{}_monthly'.format(schema, table),))
+        if cursor.fetchone()[0] is None:
+            cursor.execute("""
+                CREATE TABLE {schema}.{table}_monthly AS
+                    SELECT cell_id, date, 0::integer AS nb_days, update_time, {columns} FROM {schema}.{table}
+                    WITH NO DATA;
+                ALTER TABLE {schema}.{table}_monthly ADD CONSTRAINT {table}_monthly_pk PRIMARY KEY (cell_id, date);
+            """.format(schema=schema, table=table, columns=', '.join(columns)))
+            conn.commit()
+            logging.info("Created table {}.{}_monthly".format(schema, table))
+    return columns
+
+
+def _drop_partitions(conn, schema, table, before):
+    """
+    Drop the partitions of the table (if it is partitioned by date) that only hold rows older than `before`
+    Returns the number of dropped partitions
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT n.nspname, c.relname, pg_get_expr(c.relpartbound, c.oid)
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            JOIN pg_namespace n ON n.oid = c.relnamespace
+            WHERE i.inhparent = to_regclass(%s)
+        """, ('{}.{}'.format(schema, table),))
+        partitions = cursor.fetchall()
+        nb = 0
+        for nspname, relname, bound in partitions:
+            m = _partition_upper_bound.search(bound or '')
+            if not m:
+                # DEFAULT or MAXVALUE partition
+                continue
+            try:
+                upper_bound = datetime.fromisoformat(m.group(1))
+            except ValueError:
+                continue
+            if upper_bound <= before:
+                cursor.execute('DROP TABLE "{}"."{}"'.format(nspname, relname))
+                conn.commit()
+                logging.info("Dropped partition {}.{} (up to {})".format(nspname, relname, upper_bound))
+                nb += 1
+    return nb
+
+
+def _delete_by_date_ranges(conn, schema, table, batch_days, condition=None, params=None, before=None):
+    """
+    Delete the rows older than `before` (if set) and matching the condition (if set), by date ranges of batch_days
+    days, one transaction per range. Without condition, the partitions older than `before` are dropped first
+    Returns the number of deleted rows
+    """
+    params = dict(params or {})
+    if before is not None and condition is None:
+        _drop_partitions(conn, schema, table, before)
+    where = ' AND '.join([w for w in [condition, 'date < %(before)s' if before is not None else None] if w]) or 'true'
+    params['before'] = before
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT min(date), max(date) FROM {schema}.{table} WHERE {where}".format(
+            schema=schema, table=table, where=where), params)
+        first_date, last_date = cursor.fetchone()
+        if first_date is None:
+            return 0
+        nb = 0
+        start = first_date
+        while start <= last_date:
+            end = start + timedelta(days=batch_days)
+            cursor.execute("DELETE FROM {schema}.{table} WHERE date >= %(start)s AND date < %(end)s AND {where}".format(
+                schema=schema, table=table, where=where), dict(params, start=start, end=end))
+            nb += cursor.rowcount
+            conn.commit()
+            start = end
+    return nb